@@ -0,0 +1,323 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared helpers for the benchmarks: generated configs, a server running
+in a child process and a minimal simulated AO client.
+"""
+
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_BOOTSTRAP = "from server.tsuserver import TsuServer3; TsuServer3().start()"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    """ Lifts the soft open file limit so thousands of sockets fit. """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def generate_config(path, areas=10, characters=100, songs=500, **overrides):
+    """ Writes a complete server config directory tree into path.
+
+    :param path: directory to create config/, logs/ and storage/ in
+    :param areas: number of areas
+    :param characters: number of characters
+    :param songs: number of songs, split into categories of 50
+    :param overrides: values to override in config.yaml
+    :return: the generated config.yaml contents
+    """
+    for d in ("config", "logs", "storage"):
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+
+    config = {
+        "hostname": "<dollar>H",
+        "globalname": "<dollar>G",
+        "playerlimit": 100000,
+        "port": free_port(),
+        "local": True,
+        "guardpass": "guard",
+        "modpass": "mod",
+        "motd": "Benchmark server",
+        "use_websockets": False,
+        "websocket_port": free_port(),
+        "use_district": False,
+        "district_ip": "127.0.0.1",
+        "district_port": 11037,
+        "district_password": "bench",
+        "use_masterserver": False,
+        "masterserver_ip": "127.0.0.1",
+        "masterserver_port": 27016,
+        "masterserver_name": "Benchmark",
+        "masterserver_description": "Benchmark",
+        "timeout": 3600,
+        "debug": False,
+    }
+    config.update(overrides)
+
+    area_list = [
+        {"area": "Area {}".format(i), "background": "gs4", "bglock": False}
+        for i in range(areas)
+    ]
+    char_list = ["Char{}".format(i) for i in range(characters)]
+    music_list = []
+    for i in range(songs):
+        if i % 50 == 0:
+            music_list.append({"category": "Category {}".format(i // 50), "songs": []})
+        music_list[-1]["songs"].append({"name": "Song {}.opus".format(i), "length": 60})
+
+    files = {
+        "config.yaml": config,
+        "areas.yaml": area_list,
+        "characters.yaml": char_list,
+        "music.yaml": music_list,
+        "backgrounds.yaml": ["gs4", "gs5"],
+    }
+    for name, data in files.items():
+        with open(os.path.join(path, "config", name), "w") as f:
+            yaml.dump(data, f, sort_keys=False)
+    return config
+
+
+class ServerProcess:
+    """ A TsuServer3 instance running in a child process with generated configs. """
+
+    CONTENT_FILES = ("areas.yaml", "characters.yaml", "music.yaml", "backgrounds.yaml")
+
+    def __init__(self, workdir=None, content_dir=None, **config_kwargs):
+        """
+        :param workdir: directory to run the server in, temporary if None
+        :param content_dir: config directory to take areas, characters, music
+        and backgrounds from instead of generating them
+        :param config_kwargs: passed on to generate_config
+        """
+        self._tmp = None
+        if workdir is None:
+            self._tmp = tempfile.TemporaryDirectory(prefix="tsuserver-bench-")
+            workdir = self._tmp.name
+        self.workdir = workdir
+        self.config = generate_config(workdir, **config_kwargs)
+        if content_dir:
+            for name in self.CONTENT_FILES:
+                shutil.copy(
+                    os.path.join(content_dir, name),
+                    os.path.join(workdir, "config", name),
+                )
+        self.process = None
+
+    @property
+    def port(self):
+        return self.config["port"]
+
+    @property
+    def websocket_port(self):
+        return self.config["websocket_port"]
+
+    def start(self, timeout=30):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [REPO_ROOT, env.get("PYTHONPATH")])
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", SERVER_BOOTSTRAP],
+            cwd=self.workdir,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    "Server exited with code {}.".format(self.process.returncode)
+                )
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Server did not start listening in time.")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._tmp:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def rss_bytes(self):
+        """ Resident memory of the server process, None where /proc is missing. """
+        try:
+            with open("/proc/{}/status".format(self.process.pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def cpu_seconds(self):
+        """ User + system CPU time of the server process, None where /proc is missing. """
+        try:
+            with open("/proc/{}/stat".format(self.process.pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        ticks = os.sysconf("SC_CLK_TCK")
+        return (int(fields[11]) + int(fields[12])) / ticks
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class SimulatedClient:
+    """ A bare-bones AO client speaking either raw TCP or WebSocket. """
+
+    def __init__(self, host, port, websocket=False, on_packet=None):
+        self.host = host
+        self.port = port
+        self.websocket = websocket
+        self.on_packet = on_packet
+        self.reader = None
+        self.writer = None
+        self.ws = None
+        self.buffer = ""
+        self.bytes_received = 0
+        self.packets_received = 0
+        self.waiters = {}
+        self.read_task = None
+
+    async def connect(self):
+        if self.websocket:
+            import websockets
+
+            self.ws = await websockets.connect(
+                "ws://{}:{}".format(self.host, self.port), max_size=None
+            )
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        self.read_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                if self.websocket:
+                    data = await self.ws.recv()
+                else:
+                    data = (await self.reader.read(65536)).decode("utf-8", "ignore")
+                    if not data:
+                        break
+                self.bytes_received += len(data)
+                self.buffer += data
+                while "#%" in self.buffer:
+                    msg, self.buffer = self.buffer.split("#%", 1)
+                    self._handle_packet(msg.split("#"))
+        except Exception:
+            pass
+        finally:
+            for fut, _ in self.waiters.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("Connection closed."))
+
+    def _handle_packet(self, packet):
+        self.packets_received += 1
+        if self.on_packet:
+            self.on_packet(self, packet)
+        waiter = self.waiters.get(packet[0])
+        if waiter is None:
+            return
+        fut, check = waiter
+        if check is None or check(packet[1:]):
+            del self.waiters[packet[0]]
+            if not fut.done():
+                fut.set_result(packet[1:])
+
+    def send_bytes(self, data):
+        if self.websocket:
+            asyncio.ensure_future(self.ws.send(data.decode("utf-8", "ignore")))
+        else:
+            self.writer.write(data)
+
+    async def send_bytes_drained(self, data):
+        """ Sends data, waiting while the socket's write buffer is full,
+        so a slow server can't make the unsent data grow without bound.
+        """
+        if self.websocket:
+            await self.ws.send(data.decode("utf-8", "ignore"))
+        else:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    def send_raw(self, msg):
+        if self.websocket:
+            asyncio.ensure_future(self.ws.send(msg))
+        else:
+            self.writer.write(msg.encode("utf-8"))
+
+    def send(self, cmd, *args):
+        self.send_raw("#".join([cmd] + [str(x) for x in args]) + "#%")
+
+    async def request(self, expected, cmd, *args, timeout=10, check=None):
+        """ Sends a packet and waits for the first reply of the given command.
+
+        :param check: optional predicate the reply's arguments must satisfy
+        """
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[expected] = (fut, check)
+        self.send(cmd, *args)
+        return await asyncio.wait_for(fut, timeout)
+
+    async def close(self):
+        if self.websocket:
+            if self.ws:
+                await self.ws.close()
+        elif self.writer:
+            self.writer.close()
+        if self.read_task:
+            self.read_task.cancel()
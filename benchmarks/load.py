@@ -0,0 +1,331 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator that drives many simulated AO clients against a local server.
+
+Usage (from the repository root):
+
+    python -m benchmarks.load --clients 2000 --areas 20 --duration 60 -o out.json
+
+Every client performs the full handshake (HI, ID, askchaa, RC, RM, RD, CC),
+moves into its area and then sends a weighted mix of IC, OOC, music and
+evidence traffic. IC messages carry their send timestamp, so the delivery
+latency to every listener in the area can be measured end to end.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+
+from benchmarks.harness import ServerProcess, SimulatedClient, raise_fd_limit
+from server.util.perf import LatencyHistogram
+
+IC_TAG = "bench"
+
+
+class LoadStats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.sent = {"ic": 0, "ooc": 0, "music": 0, "evidence": 0}
+        self.ms_received = 0
+        self.handshake = LatencyHistogram()
+        self.ms_latency = LatencyHistogram()
+
+    def on_packet(self, _, packet):
+        if packet[0] != "MS" or len(packet) < 6:
+            return
+        text = packet[5].split(" ")
+        if len(text) != 3 or text[0] != IC_TAG:
+            return
+        self.ms_received += 1
+        self.ms_latency.record((time.perf_counter_ns() - int(text[2])) // 1000)
+
+    def histogram_summary(self, hist):
+        return {
+            "count": hist.count,
+            "mean_us": round(hist.mean(), 1),
+            "p50_us": hist.percentile(50),
+            "p90_us": hist.percentile(90),
+            "p99_us": hist.percentile(99),
+            "p999_us": hist.percentile(99.9),
+            "max_us": hist.max,
+        }
+
+
+class LoadClient:
+    def __init__(self, idx, args, server, stats, websocket):
+        self.idx = idx
+        self.args = args
+        self.stats = stats
+        self.rand = random.Random(args.seed * 100003 + idx)
+        self.area_idx = idx % args.areas
+        self.char_id = -1
+        self.hdid = "bench{}".format(idx)
+        port = server.websocket_port if websocket else server.port
+        self.conn = SimulatedClient(
+            "127.0.0.1", port, websocket=websocket, on_packet=self.on_packet
+        )
+        self.seq = 0
+        self.evidence_count = 0
+
+    def on_packet(self, conn, packet):
+        if packet[0] == "PV" and len(packet) >= 4:
+            self.char_id = int(packet[3])
+        elif packet[0] == "LE":
+            self.evidence_count = len([x for x in packet[1:] if x])
+        self.stats.on_packet(conn, packet)
+
+    async def handshake(self):
+        conn = self.conn
+        start = time.perf_counter_ns()
+        await conn.connect()
+        await conn.request("ID", "HI", self.hdid)
+        await conn.request("FL", "ID", "AOClassic", "2.8.0")
+        await conn.request("SI", "askchaa")
+        await conn.request("SC", "RC")
+        await conn.request("SM", "RM")
+        await conn.request("DONE", "RD")
+
+        # everyone joins the default area first, so characters are handed out
+        # so that its residents never collide with clients passing through
+        per_area = -(-self.args.clients // self.args.areas)
+        if self.area_idx == 0:
+            char_id = self.idx // self.args.areas
+        else:
+            char_id = per_area + self.idx % max(1, self.args.characters - per_area)
+        char_id %= self.args.characters
+
+        # the server ignores CC for a taken character, so retry on timeout
+        for _ in range(10):
+            try:
+                await conn.request(
+                    "PV",
+                    "CC",
+                    0,
+                    char_id,
+                    self.hdid,
+                    timeout=2,
+                    check=lambda reply, cid=char_id: reply[2] == str(cid),
+                )
+                break
+            except asyncio.TimeoutError:
+                char_id = self.rand.randrange(per_area, self.args.characters)
+        else:
+            raise ConnectionError("Could not pick a character.")
+
+        if self.area_idx != 0:
+            await conn.request(
+                "LE", "MC", "Area {}".format(self.area_idx), self.char_id
+            )
+        self.stats.handshake.record((time.perf_counter_ns() - start) // 1000)
+
+    def send_ic(self):
+        self.seq += 1
+        text = "{} {} {}".format(IC_TAG, self.seq, time.perf_counter_ns())
+        self.conn.send(
+            "MS",
+            "chat",  # msg_type
+            "-",  # pre
+            "Char{}".format(self.char_id),  # folder
+            "normal",  # anim
+            text,
+            "wit",  # pos
+            "0",  # sfx
+            0,  # anim_type
+            self.char_id,
+            0,  # sfx_delay
+            0,  # button
+            0,  # evidence
+            0,  # flip
+            0,  # ding
+            0,  # color
+            "",  # showname
+            -1,  # charid_pair
+            0,  # offset_pair
+            0,  # nonint_pre
+            0,  # looping SFX
+            0,  # screenshake
+            "-",  # screenshake frame
+            "-",  # realization frame
+            "-",  # sfx frame
+        )
+        self.stats.sent["ic"] += 1
+
+    def send_ooc(self):
+        if self.rand.random() < 0.2:
+            msg = "/roll {}".format(self.rand.randint(1, 100))
+        else:
+            msg = "benchmark chatter {}".format(self.seq)
+        self.conn.send("CT", "bot{}".format(self.idx), msg)
+        self.stats.sent["ooc"] += 1
+
+    def send_music(self):
+        song = "Song {}.opus".format(self.rand.randrange(self.args.songs))
+        self.conn.send("MC", song, self.char_id)
+        self.stats.sent["music"] += 1
+
+    def send_evidence(self):
+        action = self.rand.random()
+        if self.evidence_count == 0 or action < 0.4:
+            self.conn.send("PE", "Evidence {}".format(self.seq), "Bench", "empty.png")
+        elif action < 0.7:
+            self.conn.send("EE", 0, "Edited {}".format(self.seq), "Bench", "empty.png")
+        else:
+            self.conn.send("DE", 0)
+        self.stats.sent["evidence"] += 1
+
+    async def run_traffic(self, deadline):
+        actions = (self.send_ic, self.send_ooc, self.send_music, self.send_evidence)
+        weights = (self.args.ic, self.args.ooc, self.args.music, self.args.evidence)
+        while True:
+            delay = self.rand.expovariate(self.args.rate)
+            if time.monotonic() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+            self.rand.choices(actions, weights)[0]()
+
+
+async def run_load(args, server):
+    stats = LoadStats()
+    clients = [
+        LoadClient(i, args, server, stats, i < args.clients * args.ws_ratio)
+        for i in range(args.clients)
+    ]
+    sem = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with sem:
+            try:
+                await client.handshake()
+                stats.connected += 1
+                return client
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                stats.failed += 1
+                return None
+
+    rss_idle = server.rss_bytes()
+    connect_start = time.monotonic()
+    ready = [c for c in await asyncio.gather(*map(connect, clients)) if c]
+    connect_time = time.monotonic() - connect_start
+    rss_loaded = server.rss_bytes()
+
+    cpu_start = server.cpu_seconds()
+    recv_start = sum(c.conn.bytes_received for c in ready)
+    traffic_start = time.monotonic()
+    deadline = traffic_start + args.duration
+    await asyncio.gather(*(c.run_traffic(deadline) for c in ready))
+    await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+    # give in-flight messages a moment to arrive
+    await asyncio.sleep(1)
+    elapsed = time.monotonic() - traffic_start
+    cpu_end = server.cpu_seconds()
+    recv_bytes = sum(c.conn.bytes_received for c in ready) - recv_start
+
+    for c in ready:
+        await c.conn.close()
+
+    sent_total = sum(stats.sent.values())
+    result = {
+        "clients_connected": stats.connected,
+        "clients_failed": stats.failed,
+        "connect_seconds": round(connect_time, 3),
+        "handshake": stats.histogram_summary(stats.handshake),
+        "traffic_seconds": round(elapsed, 3),
+        "sent": dict(stats.sent, total=sent_total),
+        "sent_per_second": round(sent_total / elapsed, 1),
+        "ms_deliveries": stats.ms_received,
+        "ms_deliveries_per_second": round(stats.ms_received / elapsed, 1),
+        "ms_latency": stats.histogram_summary(stats.ms_latency),
+        "received_bytes_per_second": round(recv_bytes / elapsed, 1),
+        "server_rss_idle_bytes": rss_idle,
+        "server_rss_loaded_bytes": rss_loaded,
+        "server_cpu_percent": None,
+        "server_bytes_per_client": None,
+    }
+    if cpu_start is not None and cpu_end is not None:
+        result["server_cpu_percent"] = round(100 * (cpu_end - cpu_start) / elapsed, 1)
+    if rss_idle is not None and rss_loaded is not None and stats.connected:
+        result["server_bytes_per_client"] = (rss_loaded - rss_idle) // stats.connected
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--areas", type=int, default=10)
+    parser.add_argument("--characters", type=int, default=200)
+    parser.add_argument("--songs", type=int, default=1000)
+    parser.add_argument(
+        "--ws-ratio",
+        type=float,
+        default=0.0,
+        help="fraction of clients connecting over WebSocket (needs websockets)",
+    )
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument(
+        "--rate", type=float, default=0.5, help="messages per second per client"
+    )
+    parser.add_argument("--ic", type=float, default=0.5, help="IC traffic weight")
+    parser.add_argument("--ooc", type=float, default=0.3, help="OOC traffic weight")
+    parser.add_argument("--music", type=float, default=0.15, help="music weight")
+    parser.add_argument("--evidence", type=float, default=0.05, help="evidence weight")
+    parser.add_argument("--connect-concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+    if args.characters < -(-args.clients // args.areas):
+        parser.error("Not enough characters for that many clients per area.")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    server = ServerProcess(
+        areas=args.areas,
+        characters=args.characters,
+        songs=args.songs,
+        use_websockets=args.ws_ratio > 0,
+    )
+    server.start()
+    try:
+        result = asyncio.run(run_load(args, server))
+    finally:
+        server.stop()
+
+    report = {
+        "benchmark": "load",
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": vars(args),
+        "results": result,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
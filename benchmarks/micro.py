@@ -0,0 +1,363 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks for the protocol and state hot paths.
+
+Usage (from the repository root):
+
+    python -m benchmarks.micro                  # compare against the baseline
+    python -m benchmarks.micro --save-baseline  # record a new baseline
+    python -m benchmarks.micro -k send_command  # run a subset
+
+Every benchmark runs in-process against a real TsuServer3 built from
+generated configs, with fake transports in place of sockets. Timings are
+the best of several timeit repeats, in nanoseconds per operation. The run
+fails with a non-zero exit code if any benchmark is slower than its
+baseline by more than the allowed factor.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import timeit
+
+from benchmarks.harness import generate_config
+from server.network import codec
+from server.network.ao_protocol import AOProtocol
+from server.network.network_interface import NetworkInterface
+from server.ooc_commands.registry import registry
+from server.util.attributes import get_dict_attribute
+from server.util.content_filter import ContentFilter
+from server.util.flood_guard import FloodGuard
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+
+MS_ARGS = [
+    "chat",
+    "-",
+    "Char0",
+    "normal",
+    "Hello there, this is a fairly ordinary IC message.",
+    "wit",
+    "0",
+    "0",
+    "0",
+    "0",
+    "0",
+    "0",
+    "0",
+    "0",
+    "0",
+    "",
+    "-1",
+    "0",
+    "0",
+    "0",
+    "0",
+    "-",
+    "-",
+    "-",
+]
+
+
+class FakeTransport:
+    """ Stands in for an asyncio transport, counting written bytes. """
+
+    def __init__(self, port=0):
+        self.port = port
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, key):
+        return {"peername": ("127.0.0.1", self.port)}[key]
+
+
+@contextlib.contextmanager
+def bench_server(**config_kwargs):
+    """ Builds a TsuServer3 in a temporary directory with generated configs. """
+    from server.tsuserver import TsuServer3
+
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="tsuserver-micro-") as tmp:
+        generate_config(tmp, **config_kwargs)
+        os.chdir(tmp)
+        try:
+            yield TsuServer3()
+        finally:
+            os.chdir(old_cwd)
+
+
+def add_clients(server, area, count):
+    clients = []
+    for i in range(count):
+        c = server.client_manager.new_client(NetworkInterface(FakeTransport(i)), area)
+        area.new_client(c)
+        c.char_id = i
+        area.char_changed(c, -1)
+        clients.append(c)
+    return clients
+
+
+def make_benchmarks(server):
+    """ Returns a dict of benchmark name -> zero-argument callable. """
+    area = server.area_manager.get_default_area()
+    client = add_clients(server, area, 1)[0]
+    proto = AOProtocol(server)
+    proto.client = client
+
+    benches = {}
+
+    ms_packet = "MS#" + "#".join(MS_ARGS) + "#%"
+    stream = ms_packet * 50
+
+    def get_messages():
+        proto.buffer = stream
+        for _ in proto.get_messages():
+            pass
+
+    benches["get_messages_50_ms"] = get_messages
+
+    def validate_ms():
+        proto.validate_net_cmd(
+            list(MS_ARGS),
+            proto.ArgType.STR,
+            proto.ArgType.STR_OR_EMPTY,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+            proto.ArgType.INT,
+            proto.ArgType.INT,
+            proto.ArgType.INT,
+            proto.ArgType.STR,
+            proto.ArgType.INT,
+            proto.ArgType.BOOL,
+            proto.ArgType.BOOL,
+            proto.ArgType.INT,
+            proto.ArgType.STR_OR_EMPTY,
+            proto.ArgType.INT,
+            proto.ArgType.INT,
+            proto.ArgType.BOOL,
+            proto.ArgType.BOOL,
+            proto.ArgType.BOOL,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+            proto.ArgType.STR,
+        )
+
+    benches["validate_net_cmd_ms"] = validate_ms
+
+    ms_area = server.area_manager.areas[5]
+    ms_proto = AOProtocol(server)
+    ms_proto.client = add_clients(server, ms_area, 1)[0]
+    ms_proto.client.char_id = 0
+    # measure parsing and validation only, without queueing
+    ms_area.queue_ic_message = lambda speaker, packet, msg: True
+    benches["net_cmd_ms"] = lambda: ms_proto.net_cmd_ms(list(MS_ARGS))
+
+    ms_out = MS_ARGS[:16] + ["-1", "", "", "0", "0", "0"] + MS_ARGS[18:]
+    benches["client_send_command_ms"] = lambda: client.send_command("MS", *ms_out)
+
+    def unsafe_join(command, *args):
+        # how packets were built before the codec, for comparison
+        return "{}#{}#%".format(command, "#".join([str(x) for x in args])).encode(
+            "utf-8"
+        )
+
+    ct_args = ("Phoenix", "Objection! Exhibit #3 costs 50% more & $10 extra.")
+    benches["codec_encode_ms"] = lambda: codec.encode_command("MS", *ms_out)
+    benches["codec_unsafe_join_ms"] = lambda: unsafe_join("MS", *ms_out)
+    benches["codec_encode_ct"] = lambda: codec.encode_command("CT", *ct_args)
+    benches["codec_unsafe_join_ct"] = lambda: unsafe_join("CT", *ct_args)
+    ct_received = "CT#Phoenix#/pm 3 Exhibit <num>3 costs 50<percent> more"
+    benches["codec_decode_ct"] = lambda: codec.decode_command(ct_received)
+    benches["codec_unsafe_split_ct"] = lambda: ct_received.split("#")
+
+    for area_id, size in enumerate((10, 100, 500), start=1):
+        fan_area = server.area_manager.areas[area_id]
+        add_clients(server, fan_area, size)
+        benches["area_send_command_ms_{}".format(size)] = (
+            lambda a=fan_area: a.send_command("MS", *ms_out)
+        )
+
+    # a pairing IC message in the crowded area, the partner joined last
+    pair_area = server.area_manager.areas[3]
+    speaker, partner = min(pair_area.clients, key=lambda c: c.char_id), max(
+        pair_area.clients, key=lambda c: c.char_id
+    )
+    pair_area.queue_ic_message = lambda speaker, packet, msg: True
+    partner_proto = AOProtocol(server)
+    partner_proto.client = partner
+    partner_args = list(MS_ARGS)
+    partner_args[8] = str(partner.char_id)
+    partner_args[16] = str(speaker.char_id)
+    partner_proto.net_cmd_ms(partner_args)
+    pair_proto = AOProtocol(server)
+    pair_proto.client = speaker
+    pair_args = list(MS_ARGS)
+    pair_args[8] = str(speaker.char_id)
+    pair_args[16] = str(partner.char_id)
+    benches["net_cmd_ms_paired_500"] = lambda: pair_proto.net_cmd_ms(list(pair_args))
+
+    pm_arg = "{} hello there".format(partner.get_char_name())
+    benches["pm_targets_500"] = lambda: server.client_manager.get_targets_and_message(
+        speaker, pm_arg
+    )
+
+    # scanning cost shouldn't grow with the number of terms
+    rnd = random.Random(0)
+    terms = [
+        "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 10)))
+        for _ in range(10000)
+    ]
+    ms_text = MS_ARGS[4] * 5
+    for count in (100, 1000, 10000):
+        content_filter = ContentFilter({"censor": terms[:count]})
+        benches["filter_scan_ms_{}_terms".format(count)] = (
+            lambda f=content_filter: f.apply(ms_text)
+        )
+    content_filter = ContentFilter({"censor": terms[:1000] + ["fairly", "message"]})
+    benches["filter_censor_ms_1000_terms"] = lambda: content_filter.apply(ms_text)
+
+    # alternating messages, so the guard never suppresses
+    flood_guard = FloodGuard(limits={"client": 100, "ip": 100, "area": 100})
+    flood_texts = [MS_ARGS[4] + str(i) for i in range(16)]
+    flood_i = iter(range(1 << 62))
+    benches["flood_guard_check_ms"] = lambda: flood_guard.check(
+        "MS", client, flood_texts[next(flood_i) & 15]
+    )
+
+    attrs = client._attributes
+    benches["get_dict_attribute"] = lambda: get_dict_attribute(
+        attrs, "ic.pairing.target_char_id"
+    )
+
+    done_area = server.area_manager.areas[4]
+    done_client = add_clients(server, done_area, 50)[0]
+    for i in range(20):
+        done_area.evidence_manager.add_evidence(
+            "Evidence {}".format(i), "Some description", "empty.png"
+        )
+    benches["client_send_done"] = done_client.send_done
+
+    for mod in list(server.client_manager.clients)[:3]:
+        mod.set_attr("is_moderator", True)
+    benches["broadcast_modcall"] = lambda: server.broadcast_modcall(client, "help")
+
+    pm = registry.get_command("pm")
+    benches["ooc_command_parse_pm"] = lambda: pm.parse("Char0: hello there")
+
+    last_song = server.music_list[-1]["songs"][-1]["name"]
+    benches["get_song_data_last"] = lambda: server.get_song_data(last_song)
+
+    server.ban_manager.bans = [
+        "10.0.{}.{}".format(i // 256, i % 256) for i in range(10000)
+    ]
+    benches["ban_manager_is_banned_miss"] = lambda: server.ban_manager.is_banned(
+        "127.0.0.1"
+    )
+
+    return benches
+
+
+def time_benchmark(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", "--filter", help="only run benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=2.0,
+        help="fail if slower than baseline by more than this factor",
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with bench_server(areas=6, characters=1000, songs=10000) as server:
+        benches = make_benchmarks(server)
+        if args.filter:
+            benches = {k: v for k, v in benches.items() if args.filter in k}
+        results = {}
+        for name, func in benches.items():
+            results[name] = round(time_benchmark(func, args.repeat), 1)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print("{:<32}{:>14}{:>14}{:>9}".format("benchmark", "ns/op", "baseline", "ratio"))
+    for name, value in results.items():
+        base = baseline.get(name)
+        ratio = value / base if base else None
+        print(
+            "{:<32}{:>14.1f}{:>14}{:>9}".format(
+                name,
+                value,
+                "{:.1f}".format(base) if base else "-",
+                "{:.2f}".format(ratio) if ratio else "-",
+            )
+        )
+        if ratio and ratio > args.threshold:
+            regressions.append(name)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "micro", "results": results}, f, indent=2)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to {}.".format(args.baseline))
+    elif regressions:
+        print(
+            "REGRESSION: {} slower than {}x the baseline.".format(
+                ", ".join(regressions), args.threshold
+            )
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replays a traffic capture (see use_capture in config.yaml) against a server.
+
+Usage (from the repository root):
+
+    python -m benchmarks.replay logs/traffic.cap --content config --speed 4
+
+By default a local server is started with generated content; pass the
+production config directory with --content so that character IDs, area
+and song names in the capture resolve the same way. Alternatively, --port
+(and --ws-port) replay against an already running server.
+
+Every captured connection is replayed on its own connection of the same
+kind (TCP or WebSocket), sending exactly the captured bytes at the captured
+offsets from the first captured event divided by --speed. Events of one
+connection are never reordered; when the replayer falls behind schedule
+the lag is reported. Sends wait for the socket's write buffer to drain, so
+a server that can't keep up shows up as lag rather than as unsent data
+piling up in the replayer.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.harness import ServerProcess, SimulatedClient, raise_fd_limit
+from server.network.capture import (
+    EVENT_CLOSE,
+    EVENT_DATA,
+    EVENT_OPEN,
+    KIND_WS,
+    read_capture,
+)
+from server.util.perf import LatencyHistogram
+
+
+def load_connections(path):
+    """ Groups the capture's events by connection.
+
+    :return: dict of conn_id -> list of (timestamp_ns, event, payload), the
+        timestamps relative to the first event of the capture
+    """
+    connections = {}
+    first = None
+    for conn_id, event, timestamp, payload in read_capture(path):
+        if first is None or timestamp < first:
+            first = timestamp
+        connections.setdefault(conn_id, []).append((timestamp, event, payload))
+    for events in connections.values():
+        events[:] = [(t - first, event, payload) for t, event, payload in events]
+    return connections
+
+
+class Replayer:
+    def __init__(self, connections, host, port, ws_port, speed):
+        self.connections = connections
+        self.host = host
+        self.port = port
+        self.ws_port = ws_port
+        self.speed = speed
+        self.lag = LatencyHistogram()
+        self.events = 0
+        self.bytes_sent = 0
+        self.failed = 0
+        self.lost = 0
+        self.clients = []
+
+    async def replay_connection(self, start, events):
+        loop = asyncio.get_event_loop()
+        conn = None
+        for timestamp, event, payload in events:
+            delay = start + timestamp / 1e9 / self.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.lag.record(int(-delay * 1e6))
+            self.events += 1
+            if event == EVENT_OPEN:
+                websocket = payload[:1] == KIND_WS
+                conn = SimulatedClient(
+                    self.host, self.ws_port if websocket else self.port, websocket
+                )
+                try:
+                    await conn.connect()
+                except OSError:
+                    self.failed += 1
+                    return
+                self.clients.append(conn)
+            elif event == EVENT_DATA and conn:
+                try:
+                    await conn.send_bytes_drained(payload)
+                except Exception:
+                    self.lost += 1
+                    return
+                self.bytes_sent += len(payload)
+            elif event == EVENT_CLOSE and conn:
+                await conn.close()
+                conn = None
+        if conn:
+            await conn.close()
+
+    async def run(self):
+        start = asyncio.get_event_loop().time()
+        await asyncio.gather(
+            *(
+                self.replay_connection(start, events)
+                for events in self.connections.values()
+            )
+        )
+        return asyncio.get_event_loop().time() - start
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="capture file to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="time acceleration")
+    parser.add_argument("--content", help="config directory with the server content")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="replay against a running server")
+    parser.add_argument("--ws-port", type=int, help="its WebSocket port")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    connections = load_connections(args.capture)
+    events = [e for conn in connections.values() for e in conn]
+    capture_seconds = max((e[0] for e in events), default=0) / 1e9
+
+    server = None
+    host, port, ws_port = args.host, args.port, args.ws_port
+    if port is None:
+        server = ServerProcess(content_dir=args.content, use_websockets=True)
+        server.start()
+        host, port, ws_port = "127.0.0.1", server.port, server.websocket_port
+
+    replayer = Replayer(connections, host, port, ws_port, args.speed)
+    cpu_start = server.cpu_seconds() if server else None
+    try:
+        elapsed = asyncio.run(replayer.run())
+        cpu_end = server.cpu_seconds() if server else None
+    finally:
+        if server:
+            server.stop()
+
+    result = {
+        "connections": len(connections),
+        "connections_failed": replayer.failed,
+        "connections_lost": replayer.lost,
+        "events": replayer.events,
+        "bytes_sent": replayer.bytes_sent,
+        "bytes_received": sum(c.bytes_received for c in replayer.clients),
+        "capture_seconds": round(capture_seconds, 3),
+        "replay_seconds": round(elapsed, 3),
+        "speed": args.speed,
+        "late_events": replayer.lag.count,
+        "lag_p50_us": replayer.lag.percentile(50),
+        "lag_p99_us": replayer.lag.percentile(99),
+        "lag_max_us": replayer.lag.max,
+        "server_cpu_seconds": None,
+    }
+    if cpu_start is not None and cpu_end is not None:
+        result["server_cpu_seconds"] = round(cpu_end - cpu_start, 3)
+
+    report = {
+        "benchmark": "replay",
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "capture": args.capture,
+        "results": result,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,9 +20,20 @@ import random
 import time
 
 from server.areas.evidence_manager import EvidenceManager
+from server.areas.history import AreaHistory, IC, OOC, JUDGE
+from server.areas.ic_queue import ICQueue
+from server.data.area_store import PERSISTED_ATTRIBUTES
+from server.network.codec import encode_command, encode_evidence_list
+from server.util import logger
 from server.util.attributes import set_dict_attribute, get_dict_attribute
 from server.util.exceptions import AreaError
 
+# the cached packets describing an area's state, see Area.get_packet
+PACKET_HP = "HP"
+PACKET_BN = "BN"
+PACKET_LE = "LE"
+PACKET_CHARS_CHECK = "CharsCheck"
+
 
 def default_attributes(name, background, bg_lock, is_casing):
     return {
@@ -35,22 +46,131 @@ def default_attributes(name, background, bg_lock, is_casing):
     }
 
 
+def index_add(index, key, client):
+    """ Adds a client to the clients kept under key, in the order they arrived. """
+    index.setdefault(key, []).append(client)
+
+
+def index_remove(index, key, client):
+    clients = index.get(key)
+    if clients and client in clients:
+        clients.remove(client)
+        if not clients:
+            del index[key]
+
+
+def index_get(index, key):
+    """ The first client kept under key, None if there is none. """
+    clients = index.get(key)
+    return clients[0] if clients else None
+
+
 class Area:
     def __init__(self, area_id, server, name, background, bg_lock, is_casing):
         self.clients = set()
         self.id = area_id
         self.name = name
         self.server = server
-        self.evidence_manager = EvidenceManager()
+        self.evidence_manager = EvidenceManager(self.evidence_changed)
         self.music_looper = None
-        self.next_message_time = 0
+        self.current_music = ""
+        self.current_music_player = ""
+        self.ic_queue = ICQueue(
+            self.send_ic_message,
+            server.config.get("ic_queue_size", 20),
+            server.config.get("ic_queue_overflow", "reject"),
+        )
+        self.history = AreaHistory(
+            server.config.get("history_size", 50),
+            server.config.get("history_bytes", 65536),
+        )
         self._attributes = default_attributes(name, background, bg_lock, is_casing)
+        # bumped by every change of the state sent to joining clients
+        self.version = 0
+        self._packets = {}
+        # char_id -> the clients playing that character here, usually one,
+        # more only after a forced character change
+        self.char_clients = {}
+        # (char_id, target_char_id) -> the clients in that character pairing with the target
+        self.pairings = {}
 
     def new_client(self, client):
         self.clients.add(client)
+        self.char_changed(client, -1)
 
     def remove_client(self, client):
         self.clients.remove(client)
+        self.ic_queue.remove_speaker(client)
+        index_remove(self.char_clients, client.char_id, client)
+        self.remove_pairing(client)
+        self.state_changed(PACKET_CHARS_CHECK)
+
+    def char_changed(self, client, old_char_id):
+        """ Updates the indexes after a client in the area changed its character. """
+        if old_char_id != -1:
+            index_remove(self.char_clients, old_char_id, client)
+        if client.char_id != -1:
+            index_add(self.char_clients, client.char_id, client)
+        self.update_pairing(client)
+        self.state_changed(PACKET_CHARS_CHECK)
+
+    def get_client_by_char_id(self, char_id):
+        return index_get(self.char_clients, char_id)
+
+    def update_pairing(self, client):
+        """ Indexes a client under its current character and pairing target. """
+        key = (client.char_id, client.get_attr("ic.pairing.target_char_id"))
+        if key == client.pairing_key:
+            return
+        self.remove_pairing(client)
+        if key[0] > -1 and key[1] > -1:
+            index_add(self.pairings, key, client)
+            client.pairing_key = key
+
+    def remove_pairing(self, client):
+        if client.pairing_key is None:
+            return
+        index_remove(self.pairings, client.pairing_key, client)
+        client.pairing_key = None
+
+    def get_pairing_partner(self, client, target_char_id):
+        """ The client playing target_char_id if it's pairing with client's character. """
+        partner = index_get(self.pairings, (target_char_id, client.char_id))
+        if partner is client:
+            return None
+        return partner
+
+    def state_changed(self, *packets):
+        """ Drops the cached packets that no longer match the area's state. """
+        self.version += 1
+        for packet in packets:
+            self._packets.pop(packet, None)
+
+    def get_packet(self, packet):
+        """ The encoded packet(s) of a part of the area's state, cached until it changes.
+
+        :param packet: PACKET_HP (both sides), PACKET_BN, PACKET_LE or PACKET_CHARS_CHECK
+        """
+        try:
+            return self._packets[packet]
+        except KeyError:
+            pass
+        if packet == PACKET_HP:
+            data = encode_command(
+                "HP", 1, self.get_attr("health.defense")
+            ) + encode_command("HP", 2, self.get_attr("health.prosecution"))
+        elif packet == PACKET_BN:
+            data = encode_command("BN", self.get_attr("background.name"))
+        elif packet == PACKET_LE:
+            data = encode_evidence_list(self.evidence_manager.get_evidence_list())
+        else:
+            taken = {c.char_id for c in self.clients}
+            data = encode_command(
+                "CharsCheck",
+                *[-1 if i in taken else 0 for i in range(len(self.server.char_list))],
+            )
+        self._packets[packet] = data
+        return data
 
     def set_attr(self, attr_path, value):
         set_dict_attribute(self._attributes, attr_path, value)
@@ -58,8 +178,35 @@ class Area:
     def get_attr(self, attr_path):
         return get_dict_attribute(self._attributes, attr_path)
 
+    def save_attr(self, attr_path):
+        if self.server.area_store:
+            self.server.area_store.save_attribute(
+                self.name, attr_path, self.get_attr(attr_path)
+            )
+
+    def evidence_changed(self):
+        self.state_changed(PACKET_LE)
+        self.save_evidence()
+
+    def save_evidence(self):
+        if self.server.area_store:
+            self.server.area_store.save_evidence(
+                self.name, self.evidence_manager.get_evidence_list()
+            )
+
+    def restore(self, state):
+        """ Restores persisted state, see AreaStore.load. """
+        for attr_path, value in state["attributes"].items():
+            if attr_path not in PERSISTED_ATTRIBUTES:
+                continue
+            if attr_path == "background.name" and value not in self.server.backgrounds:
+                continue
+            self.set_attr(attr_path, value)
+        self.evidence_manager.restore(state["evidence"])
+        self.state_changed(PACKET_HP, PACKET_BN, PACKET_LE)
+
     def is_char_available(self, char_id):
-        return char_id not in [x.char_id for x in self.clients]
+        return char_id not in self.char_clients
 
     def get_rand_avail_char_id(self):
         avail_set = set(range(len(self.server.char_list))) - set(
@@ -70,24 +217,76 @@ class Area:
         return random.choice(tuple(avail_set))
 
     def send_command(self, cmd, *args):
+        data = encode_command(cmd, *args)
         for c in self.clients:
-            c.send_command(cmd, *args)
+            c.send_raw_bytes(data)
 
     def send_host_message(self, msg):
         self.send_command("CT", self.server.config["hostname"], msg)
 
     def send_evidence_list(self):
-        evi_list = self.evidence_manager.get_evidence_list()
-        evi_packet = ["&".join(x) for x in evi_list]
+        data = self.get_packet(PACKET_LE)
         for c in self.clients:
-            c.send_command("LE", *evi_packet)
+            c.send_raw_bytes(data)
 
-    def set_next_msg_delay(self, msg_length):
-        delay = min(3000, 100 + 50 * msg_length)
-        self.next_message_time = round(time.time() * 1000.0 + delay)
+    def queue_ic_message(self, client, packet, msg):
+        """ Queues an IC message, it's broadcast as soon as the area is free.
+
+        :param client: the speaker
+        :param packet: the encoded MS packet to broadcast
+        :param msg: the message text
+        :return: False if the queue is full and the message was rejected
+        """
+        return self.ic_queue.submit(client, packet, msg)
+
+    def send_ic_message(self, client, packet, msg):
+        for c in self.clients:
+            c.send_raw_bytes(packet)
+        self.history.add(
+            IC, encode_command("CT", "[IC] {}".format(client.get_char_name()), msg)
+        )
+        logger.log_server(
+            "[IC][{}][{}]{}".format(self.id, client.get_char_name(), msg), client
+        )
+
+    def send_ooc_message(self, client, name, msg):
+        data = encode_command("CT", name, msg)
+        for c in self.clients:
+            c.send_raw_bytes(data)
+        self.history.add(OOC, data)
+        logger.log_server(
+            "[OOC][{}][{}][{}]{}".format(self.id, client.get_char_name(), name, msg),
+            client,
+        )
+
+    def add_judge_action(self, client, action):
+        """ Records a judge action for /judgelog. """
+        entry = "[{}] {} ({}) {}".format(
+            time.strftime("%H:%M:%S", time.gmtime()),
+            client.get_char_name(),
+            client.get_ip(),
+            action,
+        )
+        self.history.add(JUDGE, entry.encode("utf-8"))
+
+    def get_judgelog(self):
+        return [x.decode("utf-8") for x in self.history.entries(JUDGE)]
+
+    def send_history(self, client):
+        """ Sends the recent IC and OOC chat to a client joining the area. """
+        data = self.history.tail(self.server.config.get("history_replay", 20), IC, OOC)
+        if data:
+            client.send_raw_bytes(data)
 
     def play_music(self, name, cid, length=-1):
         self.send_command("MC", name, cid)
+        # loops replay the song as nobody, keep whoever started it
+        if cid != -1 or name != self.current_music:
+            if self.server.is_valid_char_id(cid):
+                self.current_music_player = self.server.char_list[cid]
+            else:
+                self.current_music_player = "a spectator"
+        self.current_music = name
         if self.music_looper:
             self.music_looper.cancel()
         if length > 0:
@@ -96,13 +295,10 @@ class Area:
             )
 
     def get_target_by_char_name(self, char_name):
-        for c in self.clients:
-            if c.get_char_name() == char_name:
-                return c
-        return None
-
-    def can_send_message(self):
-        return (time.time() * 1000.0 - self.next_message_time) > 0
+        char_id = self.server.char_trie.get(char_name)
+        if char_id is None:
+            return None
+        return index_get(self.char_clients, char_id)
 
     def change_hp(self, side, val):
         if not 0 <= val <= 10:
@@ -111,14 +307,19 @@ class Area:
             raise AreaError("Invalid penalty side.")
         if side == 1:
             self.set_attr("health.defense", val)
+            self.save_attr("health.defense")
         elif side == 2:
             self.set_attr("health.prosecution", val)
+            self.save_attr("health.prosecution")
+        self.state_changed(PACKET_HP)
         self.send_command("HP", side, val)
 
     def change_background(self, bg):
         if bg not in self.server.backgrounds:
             raise AreaError("Invalid background name.")
         self.set_attr("background.name", bg)
+        self.save_attr("background.name")
+        self.state_changed(PACKET_BN)
         self.send_command("BN", bg)
 
     def change_status(self, value):
@@ -135,12 +336,17 @@ class Area:
         if value == self.get_attr("status"):
             raise AreaError("This status is already set.")
         self.set_attr("status", value.upper())
+        self.save_attr("status")
         self.server.send_arup_status()
 
     def change_cm(self, name):
         name = name[:20]
+        if any(char in name for char in "#%$&"):
+            raise AreaError("The CM name can't contain #, %, $ or &.")
         self.set_attr("case.master", name)
+        self.save_attr("case.master")
         self.server.send_arup_cm()
 
     def change_doc(self, url="No document."):
         self.set_attr("case.document", url)
+        self.save_attr("case.document")
@@ -45,6 +45,18 @@ class AreaManager:
             )
             self.cur_id += 1
 
+    def restore(self, state):
+        """ Restores the persisted state of every area, see AreaStore.load. """
+        for area in self.areas:
+            if area.name in state:
+                area.restore(state[area.name])
+
+    def render_ic_queues(self):
+        lines = ["[IC QUEUE]"]
+        for area in self.areas:
+            lines.append("{}: {}".format(area.name, area.ic_queue.render()))
+        return "\r\n".join(lines)
+
     def get_default_area(self):
         return self.areas[0]
 
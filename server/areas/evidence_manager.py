@@ -21,14 +21,19 @@ LIMIT = 35
 
 
 class EvidenceManager:
-    def __init__(self):
+    def __init__(self, on_change=None):
+        """
+        :param on_change: called with no arguments after the evidence changes
+        """
         self._evidence = []
+        self.on_change = on_change
 
     def add_evidence(self, name, description, image):
         if len(self._evidence) >= LIMIT:
             raise AreaError("There are too many pieces of evidence.")
         evidence = Evidence(name, description, image)
         self._evidence.append(evidence)
+        self._changed()
 
     def edit_evidence(self, idx, name, description, image):
         try:
@@ -38,12 +43,22 @@ class EvidenceManager:
         evi.name = name
         evi.description = description
         evi.image = image
+        self._changed()
 
     def delete_evidence(self, idx):
         try:
             del self._evidence[idx]
         except IndexError:
             raise AreaError("Invalid evidence ID.")
+        self._changed()
+
+    def restore(self, evi_list):
+        """ Replaces the evidence without notifying on_change. """
+        self._evidence = [Evidence(*x) for x in evi_list[:LIMIT]]
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
 
     def get_evidence_list(self):
         evi_items = [[x.name, x.description, x.image] for x in self._evidence]
@@ -0,0 +1,70 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+from collections import deque
+
+IC = "ic"
+OOC = "ooc"
+JUDGE = "judge"
+
+
+class AreaHistory:
+    """ Bounded ring buffers of recent IC, OOC and judge entries of an area.
+
+    Entries are kept as already encoded bytes. Every kind holds at most
+    capacity entries and all kinds together at most max_bytes, when over
+    budget, the oldest entry of the kind taking up the most bytes goes.
+    """
+
+    def __init__(self, capacity=50, max_bytes=65536):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = {IC: deque(), OOC: deque(), JUDGE: deque()}
+        self._sizes = {IC: 0, OOC: 0, JUDGE: 0}
+        self._seq = itertools.count()
+
+    def add(self, kind, data):
+        """
+        :param kind: IC, OOC or JUDGE
+        :param data: the encoded entry
+        """
+        entries = self._entries[kind]
+        entries.append((next(self._seq), data))
+        self._sizes[kind] += len(data)
+        self.size += len(data)
+        if len(entries) > self.capacity:
+            self._evict(kind)
+        while self.size > self.max_bytes:
+            self._evict(max(self._sizes, key=self._sizes.get))
+
+    def _evict(self, kind):
+        _, data = self._entries[kind].popleft()
+        self._sizes[kind] -= len(data)
+        self.size -= len(data)
+
+    def entries(self, kind):
+        return [data for _, data in self._entries[kind]]
+
+    def tail(self, count, *kinds):
+        """ The last count entries of the given kinds, oldest first, in one buffer. """
+        if count <= 0:
+            return b""
+        merged = heapq.merge(*(self._entries[kind] for kind in kinds))
+        return b"".join(data for _, data in deque(merged, maxlen=count))
@@ -0,0 +1,158 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+from collections import deque
+
+from server.util.perf import LatencyHistogram, format_us
+
+OVERFLOW_REJECT = "reject"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+
+
+def message_delay(msg_length):
+    """ How long the area stays busy after a message, in seconds. """
+    return min(3000, 100 + 50 * msg_length) / 1000.0
+
+
+class ICQueue:
+    """ A bounded queue pacing the IC messages of a single area.
+
+    Messages are broadcast no faster than message_delay allows. While the
+    area is busy, messages wait in per-speaker queues which are drained
+    round-robin, so a single fast typist can't starve everyone else.
+
+    On overflow, the reject policy refuses the new message, the drop_oldest
+    policy evicts the oldest message of the speaker with the most pending.
+    """
+
+    def __init__(self, send, capacity=20, overflow=OVERFLOW_REJECT):
+        """
+        :param send: called as send(client, packet, msg) to broadcast a message
+        :param capacity: maximum number of pending messages
+        :param overflow: overflow policy, reject or drop_oldest
+        """
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError("Invalid IC queue overflow policy: {}".format(overflow))
+        self.send = send
+        self.capacity = max(1, capacity)
+        self.overflow = overflow
+        self.next_time = 0.0
+        self.depth = 0
+        self._pending = {}
+        self._order = deque()
+        self._timer = None
+
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.deduplicated = 0
+        self.wait = LatencyHistogram()
+
+    def submit(self, client, packet, msg):
+        """ Broadcasts a message now, or queues it until the area is free.
+
+        :param client: the speaker
+        :param packet: the encoded MS packet
+        :param msg: the message text, its length determines the delay
+        :return: False if the message was rejected, True otherwise
+        """
+        now = time.monotonic()
+        if not self.depth and now >= self.next_time:
+            self._send(now, now, client, packet, msg)
+            return True
+
+        queue = self._pending.get(client)
+        if queue is not None:
+            for _, queued_packet, _ in queue:
+                if queued_packet == packet:
+                    self.deduplicated += 1
+                    return True
+
+        if self.depth >= self.capacity:
+            if self.overflow == OVERFLOW_REJECT:
+                self.dropped += 1
+                return False
+            longest = max(self._pending, key=lambda c: len(self._pending[c]))
+            self._pop(longest)
+            self.dropped += 1
+            queue = self._pending.get(client)
+
+        if queue is None:
+            queue = self._pending[client] = deque()
+            self._order.append(client)
+        queue.append((now, packet, msg))
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._schedule()
+        return True
+
+    def remove_speaker(self, client):
+        """ Discards all pending messages of a client, e.g. when they leave. """
+        queue = self._pending.pop(client, None)
+        if queue is None:
+            return
+        self.depth -= len(queue)
+        self._order.remove(client)
+
+    def _pop(self, client):
+        queue = self._pending[client]
+        item = queue.popleft()
+        self.depth -= 1
+        if not queue:
+            del self._pending[client]
+            self._order.remove(client)
+        return item
+
+    def _send(self, now, queued_at, client, packet, msg):
+        self.next_time = now + message_delay(len(msg))
+        self.sent += 1
+        self.wait.record(int((now - queued_at) * 1000000))
+        self.send(client, packet, msg)
+
+    def _schedule(self):
+        if self._timer is None and self.depth:
+            delay = max(0.0, self.next_time - time.monotonic())
+            self._timer = asyncio.get_event_loop().call_later(delay, self._drain)
+
+    def _drain(self):
+        self._timer = None
+        now = time.monotonic()
+        if self.depth and now >= self.next_time:
+            client = self._order[0]
+            queued_at, packet, msg = self._pop(client)
+            # move the speaker to the back of the line
+            if client in self._pending:
+                self._order.rotate(-1)
+            self._send(now, queued_at, client, packet, msg)
+        self._schedule()
+
+    def render(self):
+        return (
+            "depth={} max={} sent={} dropped={} dedup={} "
+            "wait p50={} p99={} max={}"
+        ).format(
+            self.depth,
+            self.max_depth,
+            self.sent,
+            self.dropped,
+            self.deduplicated,
+            format_us(self.wait.percentile(50)),
+            format_us(self.wait.percentile(99)),
+            format_us(self.wait.max),
+        )
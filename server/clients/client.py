@@ -14,10 +14,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from server.areas.area import PACKET_BN, PACKET_CHARS_CHECK, PACKET_HP, PACKET_LE
+from server.network.codec import encode_command
 from server.util import logger
 from server.util.attributes import set_dict_attribute, get_dict_attribute
 from server.util.exceptions import ClientError, AreaError
 
+MM_PACKET = encode_command("MM", 1)
+DONE_PACKET = encode_command("DONE")
+
+# attributes deciding which broadcasts a client is subscribed to
+SUBSCRIPTION_ATTRIBUTES = ("is_moderator", "global.muted", "adverts.muted")
+
 
 def default_attributes():
     return {
@@ -45,20 +53,18 @@ class Client:
         self.area = area
         self.server = server
         self.software = None
+        # the key under which area.pairings holds this client
+        self.pairing_key = None
         self._attributes = default_attributes()
 
-    def _send_raw_message(self, msg):
+    def send_raw_bytes(self, data):
+        """ Sends already encoded packets. """
         if self.server.config["debug"]:
-            print(logger.log_debug(f"[SND]{msg}", self))
-        self.network.send_raw_message(msg)
+            print(logger.log_debug("[SND]{}".format(data.decode("utf-8")), self))
+        self.server.perf.bytes_sent += self.network.send_raw_bytes(data)
 
     def send_command(self, command, *args):
-        if args:
-            self._send_raw_message(
-                "{}#{}#%".format(command, "#".join([str(x) for x in args]))
-            )
-        else:
-            self._send_raw_message("{}#%".format(command))
+        self.send_raw_bytes(encode_command(command, *args))
 
     def send_host_message(self, msg):
         self.send_command("CT", self.server.config["hostname"], msg)
@@ -70,6 +76,8 @@ class Client:
 
     def set_attr(self, attr_path, value):
         set_dict_attribute(self._attributes, attr_path, value)
+        if attr_path in SUBSCRIPTION_ATTRIBUTES:
+            self.server.client_manager.update_subscriptions(self)
 
     def get_attr(self, attr_path):
         return get_dict_attribute(self._attributes, attr_path)
@@ -83,7 +91,9 @@ class Client:
         if not force and not self.area.is_char_available(char_id):
             raise ClientError("Character not available.")
         old_char = self.get_char_name()
+        old_char_id = self.char_id
         self.char_id = char_id
+        self.area.char_changed(self, old_char_id)
         self.send_command("PV", self.id, "CID", self.char_id)
         logger.log_server(
             "[{}]Changed character from {} to {}.".format(
@@ -132,10 +142,12 @@ class Client:
             self,
         )
 
-        self.send_command("HP", 1, self.area.get_attr("health.defense"))
-        self.send_command("HP", 2, self.area.get_attr("health.prosecution"))
-        self.send_command("BN", self.area.get_attr("background.name"))
-        self.send_evidence_list()
+        self.send_raw_bytes(
+            self.area.get_packet(PACKET_HP)
+            + self.area.get_packet(PACKET_BN)
+            + self.area.get_packet(PACKET_LE)
+        )
+        self.area.send_history(self)
         self.server.send_arup_players()
 
     def get_area_info(self, area_id):
@@ -166,28 +178,27 @@ class Client:
         self.send_host_message(info)
 
     def send_evidence_list(self):
-        evi_list = self.area.evidence_manager.get_evidence_list()
-        evi_packet = ["&".join(x) for x in evi_list]
-        self.send_command("LE", *evi_packet)
+        self.send_raw_bytes(self.area.get_packet(PACKET_LE))
 
     def send_done(self):
-        avail_char_ids = set(range(len(self.server.char_list))) - set(
-            [x.char_id for x in self.area.clients]
+        area = self.area
+        self.send_raw_bytes(
+            b"".join(
+                (
+                    area.get_packet(PACKET_CHARS_CHECK),
+                    area.get_packet(PACKET_HP),
+                    area.get_packet(PACKET_BN),
+                    MM_PACKET,
+                    area.get_packet(PACKET_LE),
+                    DONE_PACKET,
+                )
+            )
         )
-        char_list = [-1] * len(self.server.char_list)
-        for x in avail_char_ids:
-            char_list[x] = 0
-        self.send_command("CharsCheck", *char_list)
-        self.send_command("HP", 1, self.area.get_attr("health.defense"))
-        self.send_command("HP", 2, self.area.get_attr("health.prosecution"))
-        self.send_command("BN", self.area.get_attr("background.name"))
-        self.send_command("MM", 1)
-        self.send_evidence_list()
-
-        self.send_command("DONE")
 
     def char_select(self):
+        old_char_id = self.char_id
         self.char_id = -1
+        self.area.char_changed(self, old_char_id)
         self.send_done()
 
     def auth_mod(self, password):
@@ -15,23 +15,72 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
+
 from server.clients.client import Client
 
 
 class ClientManager:
+    """ Keeps track of all clients.
+
+    Besides the set of all clients, the clients receiving mod-only
+    messages, global chat and adverts are kept in their own sets, kept
+    up to date by Client.set_attr, so broadcasts only visit recipients.
+
+    Client IDs are reused, a new client always gets the lowest free ID, so
+    IDs stay below the peak number of connected clients and can be used
+    as indices into per-client arrays.
+    """
+
     def __init__(self, server):
         self.clients = set()
-        self.cur_id = 0
+        self.moderators = set()
+        self.global_listeners = set()
+        self.advert_listeners = set()
+        self.by_id = []
+        self.free_ids = []
+        # connections that haven't completed the handshake yet
+        self.pending = 0
         self.server = server
 
     def new_client(self, network, area):
-        c = Client(self.server, network, self.cur_id, area)
+        if self.free_ids:
+            user_id = heapq.heappop(self.free_ids)
+        else:
+            user_id = len(self.by_id)
+            self.by_id.append(None)
+        c = Client(self.server, network, user_id, area)
+        self.by_id[user_id] = c
         self.clients.add(c)
-        self.cur_id += 1
+        self.update_subscriptions(c)
         return c
 
     def remove_client(self, client):
         self.clients.remove(client)
+        self.by_id[client.id] = None
+        heapq.heappush(self.free_ids, client.id)
+        self.moderators.discard(client)
+        self.global_listeners.discard(client)
+        self.advert_listeners.discard(client)
+
+    def update_subscriptions(self, client):
+        if client not in self.clients:
+            return
+        for subscribers, subscribed in (
+            (self.moderators, client.get_attr("is_moderator")),
+            (self.global_listeners, not client.get_attr("global.muted")),
+            (self.advert_listeners, not client.get_attr("adverts.muted")),
+        ):
+            if subscribed:
+                subscribers.add(client)
+            else:
+                subscribers.discard(client)
+
+    def get_client_by_id(self, user_id):
+        """ Returns the client with the given ID, None if there is none. """
+        if 0 <= user_id < len(self.by_id):
+            return self.by_id[user_id]
+        return None
 
     def get_targets_by_ip(self, ip):
         clients = []
@@ -61,4 +110,30 @@ class ClientManager:
         ooc = self.get_targets_by_ooc_name(target)
         if ooc:
             return ooc
+        # check if it's a client ID
+        if target.isdigit():
+            c = self.get_client_by_id(int(target))
+            if c:
+                return [c]
         return None
+
+    def get_targets_and_message(self, client, arg):
+        """ Splits a command argument into its targets and a message.
+
+        The target is the text before a colon if that matches, otherwise
+        the longest character name in the client's area the text starts
+        with, otherwise its first word, see get_targets.
+
+        :return: (targets or None, message)
+        """
+        target, sep, msg = arg.partition(":")
+        if sep:
+            targets = self.get_targets(client, target.strip())
+            if targets:
+                return targets, msg.strip()
+        for char_id, rest in reversed(self.server.char_trie.prefixes(arg)):
+            c = client.area.get_client_by_char_id(char_id)
+            if c:
+                return [c], rest
+        target, _, msg = arg.partition(" ")
+        return self.get_targets(client, target), msg.strip()
@@ -0,0 +1,158 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS area_attributes (
+    area TEXT NOT NULL,
+    path TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (area, path)
+);
+CREATE TABLE IF NOT EXISTS evidence (
+    area TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    image TEXT NOT NULL,
+    PRIMARY KEY (area, position)
+);
+"""
+
+# the attributes that survive a restart
+PERSISTED_ATTRIBUTES = (
+    "status",
+    "background.name",
+    "health.defense",
+    "health.prosecution",
+    "case.master",
+    "case.document",
+)
+
+
+class AreaStore:
+    """ Persists area state to an SQLite database in WAL mode.
+
+    Mutations are put on a queue and written by a background thread, which
+    commits everything arriving within flush_interval of the first pending
+    mutation as a single transaction. Within a batch, only the latest value
+    of an attribute and the latest evidence list of an area are written.
+
+    Areas are keyed by name, so reordering areas.yaml keeps their state.
+    """
+
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.writes = 0
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._writer, name="area-store", daemon=True
+        )
+        self._thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def load(self):
+        """ Reads the whole stored state at once.
+
+        :return: dict of area name -> {"attributes": {path: value}, "evidence": [[name, description, image]]}
+        """
+        state = {}
+        conn = self._connect()
+        try:
+            for area, path, value in conn.execute(
+                "SELECT area, path, value FROM area_attributes"
+            ):
+                entry = state.setdefault(area, {"attributes": {}, "evidence": []})
+                entry["attributes"][path] = json.loads(value)
+            for area, name, description, image in conn.execute(
+                "SELECT area, name, description, image FROM evidence ORDER BY area, position"
+            ):
+                entry = state.setdefault(area, {"attributes": {}, "evidence": []})
+                entry["evidence"].append([name, description, image])
+        finally:
+            conn.close()
+        return state
+
+    def save_attribute(self, area_name, attr_path, value):
+        self._queue.put(("attr", (area_name, attr_path), value))
+
+    def save_evidence(self, area_name, evidence_list):
+        """ Replaces the stored evidence of an area.
+
+        :param evidence_list: list of [name, description, image]
+        """
+        self._queue.put(("evidence", area_name, evidence_list))
+
+    def close(self):
+        """ Writes all pending mutations and stops the writer thread. """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer(self):
+        conn = self._connect()
+        running = True
+        while running:
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            pending = {}
+            while item is not None:
+                kind, key, value = item
+                pending[kind, key] = value
+                try:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+            else:
+                running = False
+            if pending:
+                self._write_batch(conn, pending)
+        conn.close()
+
+    def _write_batch(self, conn, pending):
+        with conn:
+            for (kind, key), value in pending.items():
+                if kind == "attr":
+                    area_name, attr_path = key
+                    conn.execute(
+                        "INSERT OR REPLACE INTO area_attributes VALUES (?, ?, ?)",
+                        (area_name, attr_path, json.dumps(value)),
+                    )
+                else:
+                    conn.execute("DELETE FROM evidence WHERE area = ?", (key,))
+                    conn.executemany(
+                        "INSERT INTO evidence VALUES (?, ?, ?, ?, ?)",
+                        [(key, i, *evi) for i, evi in enumerate(value)],
+                    )
+        self.batches += 1
+        self.writes += len(pending)
@@ -19,22 +19,28 @@ import json
 
 from server.util.exceptions import ServerError
 
+BANLIST_FILE = "storage/banlist.json"
+
 
 class BanManager:
-    def __init__(self):
+    def __init__(self, io):
+        self.io = io
         self.bans = []
         self.load_banlist()
 
     def load_banlist(self):
         try:
-            with open("storage/banlist.json", "r") as banlist_file:
+            with open(BANLIST_FILE, "r") as banlist_file:
                 self.bans = json.load(banlist_file)
         except FileNotFoundError:
             return
 
     def write_banlist(self):
-        with open("storage/banlist.json", "w") as banlist_file:
-            json.dump(self.bans, banlist_file)
+        """ Writes the banlist in the background.
+
+        :return: a future, done once the banlist is on disk
+        """
+        return self.io.write(BANLIST_FILE, json.dumps(self.bans))
 
     def add_ban(self, ip):
         if ip not in self.bans:
@@ -0,0 +1,120 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import os
+import tempfile
+import threading
+
+from server.util import logger
+
+
+def write_atomic(path, data):
+    """ Replaces a file, so that readers only ever see the old or the new content.
+
+    :param data: str or bytes
+    """
+    directory = os.path.dirname(path) or "."
+    mode = "wb" if isinstance(data, bytes) else "w"
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with open(fd, mode, encoding=None if mode == "wb" else "utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class PendingWrite:
+    def __init__(self, data):
+        self.data = data
+        self.future = concurrent.futures.Future()
+
+
+class IOService:
+    """ Runs blocking file I/O on a small thread pool, off the event loop.
+
+    Writes of the same file are serialized, and writes arriving while an
+    earlier one is still queued replace its data, so a burst of writes to
+    one file costs a single write of the latest data.
+
+    Methods return concurrent futures, callers that need the result can
+    await asyncio.wrap_future(future), everyone else just moves on.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="io"
+        )
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._writing = {}
+        self.writes = 0
+        self.merged = 0
+
+    def write(self, path, data):
+        """ Atomically replaces the file at path with data.
+
+        :return: a future, done once data or newer data is on disk
+        """
+        with self._lock:
+            pending = self._pending.get(path)
+            if pending is not None:
+                pending.data = data
+                self.merged += 1
+                return pending.future
+            pending = PendingWrite(data)
+            self._pending[path] = pending
+            if path not in self._writing:
+                self._executor.submit(self._write, path)
+            return pending.future
+
+    def _write(self, path):
+        with self._lock:
+            pending = self._pending.pop(path)
+            self._writing[path] = pending.future
+        try:
+            write_atomic(path, pending.data)
+            self.writes += 1
+            pending.future.set_result(None)
+        except OSError as ex:
+            logger.log_debug("Failed to write {}: {}".format(path, ex))
+            pending.future.set_exception(ex)
+        finally:
+            with self._lock:
+                del self._writing[path]
+                # a write arrived while this one was running
+                if path in self._pending:
+                    self._executor.submit(self._write, path)
+
+    def run(self, func, *args):
+        """ Runs a blocking call, e.g. loading a file, on the pool. """
+        return self._executor.submit(func, *args)
+
+    def close(self):
+        """ Waits for all pending writes and stops the pool. """
+        while True:
+            with self._lock:
+                futures = [x.future for x in self._pending.values()]
+                futures.extend(self._writing.values())
+            if not futures:
+                break
+            concurrent.futures.wait(futures)
+        self._executor.shutdown(wait=True)
@@ -18,10 +18,33 @@
 import asyncio
 from enum import Enum
 
+from server.network.capture import KIND_TCP
+from server.network.codec import decode_command
 from server.network.network_interface import NetworkInterface
-from server.ooc_commands import commands
+from server.ooc_commands.registry import registry
 from server.util import logger
 from server.util.exceptions import ClientError, AreaError, ArgumentError, ServerError
+from server.util.perf import PerfStats
+
+MS_FIELD_COUNT = 24
+# msg_type, folder, anim, text, pos, sfx, button and the three frame fields
+MS_REQUIRED_FIELDS = (0, 2, 3, 4, 5, 6, 10, 21, 22, 23)
+MS_BOOL = ("0", "1")
+MS_ALLOWED_VALUES = (
+    (0, ("chat", "0", "1")),
+    (7, ("0", "1", "2", "5", "6")),
+    (10, ("0", "1", "2", "3", "4")),
+    (12, MS_BOOL),
+    (13, MS_BOOL),
+    (14, ("0", "1", "2", "3", "4", "5", "6", "7", "8")),
+    (18, MS_BOOL),
+    (19, MS_BOOL),
+    (20, MS_BOOL),
+)
+
+
+def is_uint(value):
+    return value.isascii() and value.isdigit()
 
 
 class AOProtocol(asyncio.Protocol):
@@ -35,12 +58,19 @@ class AOProtocol(asyncio.Protocol):
         INT = (3,)
         BOOL = 4
 
+    capture_kind = KIND_TCP
+    # commands accepted before the handshake, when there's no client yet
+    PRE_HANDSHAKE_COMMANDS = ("HI",)
+
     def __init__(self, server):
         super().__init__()
         self.server = server
+        self.network = None
         self.client = None
         self.buffer = ""
         self.ping_timeout = None
+        self.handshake_timeout = None
+        self.capture_id = None
 
     def data_received(self, data):
         """ Handles any data received from the network.
@@ -50,44 +80,88 @@ class AOProtocol(asyncio.Protocol):
 
         :param data: bytes of data
         """
+        if self.capture_id is not None:
+            self.server.capture.record_data(self.capture_id, data)
         # try to decode as utf-8, ignore any erroneous characters
         self.buffer += data.decode("utf-8", "ignore")
         if len(self.buffer) > 8192:
-            self.client.disconnect()
+            self.network.disconnect()
         for msg in self.get_messages():
             if len(msg) < 2:
-                self.client.disconnect()
+                self.network.disconnect()
                 return
             try:
                 if self.server.config["debug"]:
                     print(logger.log_debug(f"[RCV]{msg}", self.client))
 
-                cmd, *args = msg.split("#")
-                self.net_cmd_dispatcher[cmd](self, args)
+                cmd, args = decode_command(msg)
+                if self.client is None and cmd not in self.PRE_HANDSHAKE_COMMANDS:
+                    continue
+                self.server.perf.measure(
+                    PerfStats.NET, cmd, self.net_cmd_dispatcher[cmd], self, args
+                )
             except KeyError:
                 return
 
     def connection_made(self, transport):
         """ Called upon a new client connecting
 
+        The connection stays pending, without a Client or area, until
+        it completes the handshake with HI.
+
         :param transport: the transport object
         """
-        self.client = self.server.new_client(NetworkInterface(transport))
-        self.ping_timeout = asyncio.get_event_loop().call_later(
-            self.server.config["timeout"], self.client.disconnect
+        if self.server.capture:
+            self.capture_id = self.server.capture.open_connection(
+                self.capture_kind, transport.get_extra_info("peername")[0]
+            )
+        self.network = NetworkInterface(transport)
+        client_manager = self.server.client_manager
+        client_manager.pending += 1
+        if client_manager.pending > self.server.config.get("max_pending", 200):
+            self.network.disconnect()
+            return
+        self.handshake_timeout = asyncio.get_event_loop().call_later(
+            self.server.config.get("handshake_timeout", 10), self.network.disconnect
         )
 
         # hopefully this will be deleted one day
-        self.client.send_command("decryptor", "NOENCRYPT")
+        self.network.send_raw_message("decryptor#NOENCRYPT#%")
 
     def connection_lost(self, exc):
         """ User disconnected
 
         :param exc: reason
         """
+        if self.capture_id is not None:
+            self.server.capture.close_connection(self.capture_id)
+        if self.client is None:
+            self.server.client_manager.pending -= 1
+            if self.handshake_timeout:
+                self.handshake_timeout.cancel()
+            return
         self.server.remove_client(self.client)
         self.ping_timeout.cancel()
 
+    def complete_handshake(self):
+        """ Turns a pending connection into a client.
+
+        :return: False if the connection was refused
+        """
+        if self.handshake_timeout is None:
+            # refused in connection_made, a WebSocket may still be closing
+            return False
+        if self.server.ban_manager.is_banned(self.network.get_ip()):
+            self.network.disconnect()
+            return False
+        self.handshake_timeout.cancel()
+        self.server.client_manager.pending -= 1
+        self.client = self.server.new_client(self.network)
+        self.ping_timeout = asyncio.get_event_loop().call_later(
+            self.server.config["timeout"], self.client.disconnect
+        )
+        return True
+
     def get_messages(self):
         """ Parses out full messages from the buffer.
 
@@ -137,10 +211,9 @@ class AOProtocol(asyncio.Protocol):
         """
         if not self.validate_net_cmd(args, self.ArgType.STR, needs_auth=False):
             return
-        self.client.hdid = args[0]
-        if self.server.ban_manager.is_banned(self.client.get_ip()):
-            self.client.disconnect()
+        if self.client is None and not self.complete_handshake():
             return
+        self.client.hdid = args[0]
         version_string = ".".join(map(str, self.server.software_version))
         self.client.send_command(
             "ID", self.client.id, self.server.software, version_string
@@ -242,6 +315,7 @@ class AOProtocol(asyncio.Protocol):
 
         """
         self.client.send_done()
+        self.client.area.send_history(self.client)
         self.server.send_arup_all()
         self.client.send_motd()
 
@@ -264,6 +338,11 @@ class AOProtocol(asyncio.Protocol):
     def net_cmd_ms(self, args):
         """ IC message.
 
+        The fields are validated as the strings they arrived as, and the
+        outgoing packet is built from the original fields, replacing only
+        the ones the server computes: text, position, color, showname and
+        the pairing fields.
+
         Refer to the implementation for details.
 
         """
@@ -272,82 +351,31 @@ class AOProtocol(asyncio.Protocol):
         ):  # Checks to see if the client has been muted by a mod
             self.client.send_host_message("You have been muted by a moderator")
             return
-        if not self.client.area.can_send_message():
-            return
-        if not self.validate_net_cmd(
-            args,
-            self.ArgType.STR,  # msg_type
-            self.ArgType.STR_OR_EMPTY,  # pre
-            self.ArgType.STR,  # folder
-            self.ArgType.STR,  # anim
-            self.ArgType.STR,  # text
-            self.ArgType.STR,  # pos
-            self.ArgType.STR,  # sfx
-            self.ArgType.INT,  # anim_type
-            self.ArgType.INT,  # char_id
-            self.ArgType.INT,  # sfx_delay
-            self.ArgType.STR,  # button
-            self.ArgType.INT,  # evidence
-            self.ArgType.BOOL,  # flip
-            self.ArgType.BOOL,  # ding
-            self.ArgType.INT,  # color
-            self.ArgType.STR_OR_EMPTY,  # showname
-            self.ArgType.INT,  # charid_pair
-            self.ArgType.INT,  # offset_pair
-            self.ArgType.BOOL,  # nonint_pre
-            self.ArgType.BOOL,  # looping SFX
-            self.ArgType.BOOL,  # screenshake
-            self.ArgType.STR,  # screenshake frame
-            self.ArgType.STR,  # realization frame
-            self.ArgType.STR,  # sfx frame
-        ):
-            return
-        (
-            msg_type,
-            pre,
-            folder,
-            anim,
-            text,
-            pos,
-            sfx,
-            anim_type,
-            cid,
-            sfx_delay,
-            button,
-            evidence,
-            flip,
-            ding,
-            color,
-            showname,
-            charid_pair,
-            offset_pair,
-            nonint_pre,
-            loop_sfx,
-            screenshake,
-            frame_screenshake,
-            frame_realization,
-            frame_sfx,
-        ) = args
-
-        if msg_type not in ("chat", "0", "1"):
+        if self.client.char_id == -1 or len(args) != MS_FIELD_COUNT:
             return
-        if anim_type not in (0, 1, 2, 5, 6):
-            return
-        if cid != self.client.char_id:
-            return
-        if sfx_delay < 0:
-            return
-        if evidence < 0:
-            return
-        if flip not in (0, 1):
+        for i in MS_REQUIRED_FIELDS:
+            if not args[i]:
+                return
+        # msg_type, anim_type, button, flip, ding, color, nonint_pre, looping SFX, screenshake
+        for i, allowed in MS_ALLOWED_VALUES:
+            if args[i] not in allowed:
+                return
+        # char_id, sfx_delay, evidence
+        if args[8] != str(self.client.char_id):
             return
-        if ding not in (0, 1):
+        if not is_uint(args[9]) or not is_uint(args[11]):
             return
-        if color not in (0, 1, 2, 3, 4, 5, 6, 7, 8):
+        try:
+            charid_pair = int(args[16])
+            int(args[17])
+        except ValueError:
             return
-        if color == 2 and not self.client.get_attr("is_moderator"):
-            color = 0
 
+        color = args[14]
+        if color == "2" and not self.client.get_attr("is_moderator"):
+            color = "0"
+
+        pos = args[5]
         if cur_pos := self.client.get_attr("ic.position"):
             pos = cur_pos
         else:
@@ -356,87 +384,79 @@ class AOProtocol(asyncio.Protocol):
             except ClientError:
                 return
 
-        button = int(button)
-        if button not in (0, 1, 2, 3, 4):
-            return
-
-        showname = showname[:15]
-
-        msg = text[:256]
+        showname = args[15][:15]
+        msg = args[4][:256]
+        if self.server.content_filter is not None:
+            msg = self.server.filter_text(self.client, msg)
+            if showname:
+                showname = self.server.filter_text(self.client, showname)
+            if msg is None or showname is None:
+                self.client.send_host_message("Your message was blocked.")
+                return
 
-        if not self.client.area.evidence_manager.is_valid_evidence(evidence):
+        if not self.client.area.evidence_manager.is_valid_evidence(int(args[11])):
+            return
+        if not self.server.check_flood(self.client, "MS", msg):
+            self.client.send_host_message(
+                "Your message repeats a recent one and was not sent."
+            )
             return
 
+        anim = args[3]
+        flip = args[12]
+        folder = args[2]
         self.client.set_attr("ic.pairing.target_char_id", charid_pair)
-        self.client.set_attr("ic.pairing.offset", offset_pair)
-        if anim_type not in (5, 6):
+        self.client.set_attr("ic.pairing.offset", args[17])
+        self.client.area.update_pairing(self.client)
+        if args[7] not in ("5", "6"):
             self.client.set_attr("ic.last_emote", anim)
         self.client.set_attr("ic.flipped", flip)
         self.client.set_attr("ic.folder", folder)
 
         # Pairing
-        other_offset = 0
+        target_char_id = charid_pair
+        charid_pair = "-1"
+        offset_pair = "0"
+        other_offset = "0"
         other_emote = ""
-        other_flip = 0
+        other_flip = "0"
         other_folder = ""
 
-        paired = False
-        if charid_pair > -1:
-            for tgt in self.client.area.clients:
-                if (
-                    tgt.char_id == self.client.get_attr("ic.pairing.target_char_id")
-                    and tgt.get_attr("ic.pairing.target_char_id") == self.client.char_id
-                    and tgt != self.client
-                    and tgt.get_attr("ic.position") == pos
-                ):
-                    paired = True
-                    other_offset = tgt.get_attr("ic.pairing.offset")
-                    other_emote = tgt.get_attr("ic.last_emote")
-                    other_flip = tgt.get_attr("ic.flipped")
-                    other_folder = tgt.get_attr("ic.folder")
-                    break
-        if not paired:
-            charid_pair = -1
-            offset_pair = 0
-
-        self.client.area.send_command(
-            "MS",
-            msg_type,
-            pre,
-            folder,
-            anim,
-            msg,
-            pos,
-            sfx,
-            anim_type,
-            cid,
-            sfx_delay,
-            button,
-            evidence,
-            flip,
-            ding,
-            color,
-            showname,
-            charid_pair,
-            other_folder,
-            other_emote,
-            offset_pair,
-            other_offset,
-            other_flip,
-            nonint_pre,
-            loop_sfx,
-            screenshake,
-            frame_screenshake,
-            frame_realization,
-            frame_sfx,
-        )
-        self.client.area.set_next_msg_delay(len(msg))
-        logger.log_server(
-            "[IC][{}][{}]{}".format(
-                self.client.area.id, self.client.get_char_name(), msg
-            ),
-            self.client,
-        )
+        if target_char_id > -1:
+            tgt = self.client.area.get_pairing_partner(self.client, target_char_id)
+            if tgt is not None:
+                ic = tgt.get_attr("ic")
+                if ic["position"] == pos:
+                    charid_pair = args[16]
+                    offset_pair = args[17]
+                    other_offset = ic["pairing"]["offset"]
+                    other_emote = ic["last_emote"]
+                    other_flip = ic["flipped"]
+                    other_folder = ic["folder"]
+
+        packet = "#".join(
+            (
+                "MS",
+                *args[0:4],
+                msg,
+                pos,
+                *args[6:14],
+                color,
+                showname,
+                charid_pair,
+                other_folder,
+                other_emote,
+                offset_pair,
+                other_offset,
+                other_flip,
+                *args[18:24],
+                "%",
+            )
+        ).encode("utf-8")
+        if not self.client.area.queue_ic_message(self.client, packet, msg):
+            self.client.send_host_message(
+                "The area is too busy, your message was not sent."
+            )
 
     def net_cmd_ct(self, args):
         """ OOC Message
@@ -447,6 +467,11 @@ class AOProtocol(asyncio.Protocol):
         if not self.validate_net_cmd(args, self.ArgType.STR, self.ArgType.STR):
             return
         ooc_name = args[0]
+        if self.server.content_filter is not None:
+            ooc_name = self.server.filter_text(self.client, ooc_name)
+            if ooc_name is None:
+                self.client.send_host_message("That name is not allowed!")
+                return
         if self.client.get_attr("ooc.name") != ooc_name:
             self.client.set_attr("ooc.name", ooc_name)
         if ooc_name.startswith(self.server.config["hostname"]) or ooc_name.startswith(
@@ -460,20 +485,29 @@ class AOProtocol(asyncio.Protocol):
             arg = ""
             if len(spl) == 2:
                 arg = spl[1][:256]
-            try:
-                getattr(commands, "ooc_cmd_{}".format(cmd))(self.client, arg)
-            except AttributeError:
+            command = registry.get_command(cmd)
+            if command is None:
                 self.client.send_host_message("Invalid command.")
+                return
+            try:
+                self.server.perf.measure(
+                    PerfStats.OOC, command.name, command, self.client, arg
+                )
             except (ClientError, AreaError, ArgumentError, ServerError) as ex:
                 self.client.send_host_message(ex)
         else:
-            self.client.area.send_command("CT", ooc_name, args[1])
-            logger.log_server(
-                "[OOC][{}][{}][{}]{}".format(
-                    self.client.area.id, self.client.get_char_name(), ooc_name, args[1],
-                ),
-                self.client,
-            )
+            message = args[1]
+            if self.server.content_filter is not None:
+                message = self.server.filter_text(self.client, message)
+                if message is None:
+                    self.client.send_host_message("Your message was blocked.")
+                    return
+            if not self.server.check_flood(self.client, "CT", message):
+                self.client.send_host_message(
+                    "Your message repeats a recent one and was not sent."
+                )
+                return
+            self.client.area.send_ooc_message(self.client, ooc_name, message)
 
     def net_cmd_mc(self, args):
         """ Play music.
@@ -517,6 +551,7 @@ class AOProtocol(asyncio.Protocol):
         if args[0] not in ("testimony1", "testimony2", "notguilty", "guilty"):
             return
         self.client.area.send_command("RT", args[0])
+        self.client.area.add_judge_action(self.client, "used {}".format(args[0]))
         logger.log_server(
             "[{}]{} used a judge action".format(
                 self.client.area.id, self.client.get_char_name()
@@ -534,6 +569,9 @@ class AOProtocol(asyncio.Protocol):
             return
         try:
             self.client.area.change_hp(args[0], args[1])
+            self.client.area.add_judge_action(
+                self.client, "changed HP ({}) to {}".format(args[0], args[1])
+            )
             logger.log_server(
                 "[{}]{} changed HP ({}) to {}".format(
                     self.client.area.id, self.client.get_char_name(), args[0], args[1]
@@ -564,7 +602,11 @@ class AOProtocol(asyncio.Protocol):
         if not self.validate_net_cmd(args, self.ArgType.INT):
             return
         idx = int(args[0])
-        self.client.area.evidence_manager.delete_evidence(idx)
+        try:
+            self.client.area.evidence_manager.delete_evidence(idx)
+        except AreaError as e:
+            self.client.send_host_message(e)
+            return
         self.client.area.send_evidence_list()
 
     def net_cmd_ee(self, args):
@@ -580,30 +622,22 @@ class AOProtocol(asyncio.Protocol):
         ):
             return
         idx = int(args[0])
-        self.client.area.evidence_manager.edit_evidence(idx, *args[1:])
+        try:
+            self.client.area.evidence_manager.edit_evidence(idx, *args[1:])
+        except AreaError as e:
+            self.client.send_host_message(e)
+            return
         self.client.area.send_evidence_list()
 
     def net_cmd_zz(self, args):
-        """ Sent on mod call.
-
-        """
+        """ Sent on mod call. """
         if not self.validate_net_cmd(args, self.ArgType.STR):
             return
 
         msg = args[0][:80]
 
         self.client.send_host_message("Moderator called.")
-        self.server.send_all_cmd_pred(
-            "ZZ",
-            "{} ({}) in {} ({}): {}".format(
-                self.client.get_char_name(),
-                self.client.get_ip(),
-                self.client.area.name,
-                self.client.area.id,
-                msg,
-            ),
-            pred=lambda c: c.get_attr("is_moderator"),
-        )
+        self.server.broadcast_modcall(self.client, msg)
         logger.log_server(
             "[{}]{} called a moderator with reason: {}.".format(
                 self.client.area.id, self.client.get_char_name(), msg
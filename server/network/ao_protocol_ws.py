@@ -20,11 +20,14 @@ import asyncio
 from websockets import ConnectionClosed
 
 from server.network.ao_protocol import AOProtocol
+from server.network.capture import KIND_WS
 
 
 class AOProtocolWS(AOProtocol):
     """ A websocket wrapper around AOProtocol. """
 
+    capture_kind = KIND_WS
+
     class TransportWrapper:
         """ A class to wrap asyncio's Transport class. """
 
@@ -36,6 +39,10 @@ class AOProtocolWS(AOProtocol):
             info = {"peername": self.ws.remote_address}
             return info[key]
 
+        def get_write_buffer_size(self):
+            transport = self.ws.transport
+            return transport.get_write_buffer_size() if transport else 0
+
         def write(self, message):
             """ Writes message to the socket. """
             message = message.decode("utf-8")
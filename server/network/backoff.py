@@ -0,0 +1,40 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+
+class Backoff:
+    """ Exponential backoff with jitter for reconnect loops.
+
+    The n-th delay is drawn uniformly from the upper half of
+    min(maximum, base * 2^n), so many servers losing the same
+    remote don't all reconnect in lockstep.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempt = 0
@@ -0,0 +1,124 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recording of inbound traffic for later replay.
+
+A capture file starts with MAGIC, followed by records of a fixed header
+(RECORD_HEADER: connection id, event, nanoseconds since the capture started,
+payload length) and the payload itself. OPEN events carry the transport kind
+(KIND_TCP or KIND_WS) followed by the peer IP, DATA events the raw bytes
+received, CLOSE events have no payload.
+"""
+
+import queue
+import struct
+import threading
+import time
+
+MAGIC = b"AOCAP\x00\x01\x00"
+RECORD_HEADER = struct.Struct("<IBQI")
+
+EVENT_OPEN = 0
+EVENT_DATA = 1
+EVENT_CLOSE = 2
+
+KIND_TCP = b"t"
+KIND_WS = b"w"
+
+
+class TrafficCapture:
+    """ Writes inbound traffic to a capture file from a background thread.
+
+    The event loop only timestamps events and puts them on a queue,
+    all packing and disk writes happen on the writer thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.started = time.monotonic_ns()
+        self._next_id = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._writer, name="traffic-capture", daemon=True
+        )
+        self._thread.start()
+
+    def open_connection(self, kind, ip):
+        """ Registers a new connection and returns its capture id. """
+        conn_id = self._next_id
+        self._next_id += 1
+        self._put(conn_id, EVENT_OPEN, kind + ip.encode("utf-8"))
+        return conn_id
+
+    def record_data(self, conn_id, data):
+        self._put(conn_id, EVENT_DATA, data)
+
+    def close_connection(self, conn_id):
+        self._put(conn_id, EVENT_CLOSE, b"")
+
+    def _put(self, conn_id, event, payload):
+        self._queue.put((conn_id, event, time.monotonic_ns(), payload))
+
+    def close(self):
+        """ Flushes all pending records and stops the writer thread. """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer(self):
+        with open(self.path, "wb") as f:
+            f.write(MAGIC)
+            next_flush = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    break
+                if item:
+                    conn_id, event, timestamp, payload = item
+                    f.write(
+                        RECORD_HEADER.pack(
+                            conn_id, event, timestamp - self.started, len(payload)
+                        )
+                    )
+                    f.write(payload)
+                if time.monotonic() >= next_flush:
+                    f.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+
+
+def read_capture(path):
+    """ Reads a capture file.
+
+    :param path: path to the capture file
+    :return: yields (conn_id, event, timestamp_ns, payload) tuples
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a traffic capture file.")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            conn_id, event, timestamp, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield conn_id, event, timestamp, payload
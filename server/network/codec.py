@@ -0,0 +1,111 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Encoding and decoding of AO packets.
+
+A packet is CMD#field#field#%. Text can't contain the framing characters,
+the client sends and expects #, %, $ and & as <num>, <percent>, <dollar>
+and <and>. Only the fields listed in ESCAPED_FIELDS and UNESCAPED_FIELDS
+are converted. Every outbound field that can carry text taken from an
+unescaped field, such as an OOC command argument, must be listed in
+ESCAPED_FIELDS. The remaining fields are either generated by the server
+or relayed in the form the client sent it, which can't break framing.
+
+Escaping leaves already escaped text unchanged, so text that is relayed
+as received can go through an escaping encoder again.
+"""
+
+ESCAPES = (("#", "<num>"), ("%", "<percent>"), ("$", "<dollar>"), ("&", "<and>"))
+UNESCAPES = tuple((escaped, char) for char, escaped in ESCAPES)
+
+# escape every field of a command, for packets with a variable number of fields
+ALL_FIELDS = None
+# command -> indices of the fields escaped when sending, or ALL_FIELDS
+ESCAPED_FIELDS = {
+    "CT": (0, 1),
+    "MC": (0,),
+    "BN": (0,),
+    "HP": ALL_FIELDS,
+    "ARUP": ALL_FIELDS,
+    "ZZ": ALL_FIELDS,
+}
+# command -> indices of the fields unescaped when receiving
+UNESCAPED_FIELDS = {"CT": (1,), "PE": (0, 1), "EE": (1, 2)}
+
+
+def escape(text):
+    # str.translate takes a slow path for multi-character replacements,
+    # a replace per character is several times faster, and most text
+    # has nothing to escape at all
+    if "#" in text or "%" in text or "$" in text or "&" in text:
+        for char, escaped in ESCAPES:
+            text = text.replace(char, escaped)
+    return text
+
+
+def unescape(text):
+    if "<" not in text:
+        return text
+    for escaped, char in UNESCAPES:
+        text = text.replace(escaped, char)
+    return text
+
+
+def encode_command(command, *args):
+    """ Encodes a packet, so it can be sent to many clients at once.
+
+    :param command: the packet name, e.g. MS
+    :param args: fields, anything but str is converted with str()
+    :return: the packet as bytes
+    """
+    if not args:
+        return (command + "#%").encode("utf-8")
+    if command not in ESCAPED_FIELDS:
+        return (command + "#" + "#".join([str(x) for x in args]) + "#%").encode("utf-8")
+    indices = ESCAPED_FIELDS[command]
+    if indices is ALL_FIELDS:
+        fields = [escape(str(x)) for x in args]
+    else:
+        fields = [str(x) for x in args]
+        for i in indices:
+            if i < len(fields):
+                fields[i] = escape(fields[i])
+    return (command + "#" + "#".join(fields) + "#%").encode("utf-8")
+
+
+def encode_evidence_list(evi_list):
+    """ Encodes the LE packet, evidence fields are separated by &.
+
+    :param evi_list: list of (name, description, image)
+    """
+    return encode_command(
+        "LE", *["&".join([escape(field) for field in x]) for x in evi_list]
+    )
+
+
+def decode_command(msg):
+    """ Splits a received packet, without the trailing #%, into its fields.
+
+    :return: (command, list of fields)
+    """
+    command, *args = msg.split("#")
+    indices = UNESCAPED_FIELDS.get(command)
+    if indices is not None:
+        for i in indices:
+            if i < len(args):
+                args[i] = unescape(args[i])
+    return command, args
@@ -17,78 +17,120 @@
 
 import asyncio
 
+from server.network.backoff import Backoff
+from server.network.codec import decode_command, escape
 from server.util import logger
 
 
 class DistrictClient:
+    """ The link to the district server, relaying global chat and adverts.
+
+    Outgoing messages go through a single bounded queue, which one writer
+    task drains, writing everything pending at once. While the district is
+    unreachable, messages keep queueing and the oldest ones are dropped
+    once the queue is full. A batch that failed to write is kept and sent
+    first after reconnecting.
+    """
+
+    QUEUE_SIZE = 1000
+
     def __init__(self, server):
         self.server = server
         self.reader = None
         self.writer = None
-        self.message_queue = []
+        self.queue = asyncio.Queue(self.QUEUE_SIZE)
+        # taken off the queue, but not written yet
+        self.unsent = []
+        self.backoff = Backoff()
+        self.dropped = 0
 
     async def connect(self):
-        loop = asyncio.get_event_loop()
         while True:
             try:
                 self.reader, self.writer = await asyncio.open_connection(
                     self.server.config["district_ip"],
                     self.server.config["district_port"],
-                    loop=loop,
                 )
+                self.backoff.reset()
                 await self.handle_connection()
-            except (ConnectionRefusedError, TimeoutError):
+            except (OSError, asyncio.IncompleteReadError):
                 pass
-            except (ConnectionResetError, asyncio.IncompleteReadError):
-                self.writer = None
-                self.reader = None
-            finally:
-                logger.log_debug(
-                    "Couldn't connect to the district, retrying in 30 seconds."
-                )
-                await asyncio.sleep(30)
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+            self.reader = None
+            delay = self.backoff.next_delay()
+            logger.log_debug(
+                "District disconnected, retrying in {:.1f} seconds.".format(delay)
+            )
+            await asyncio.sleep(delay)
 
     async def handle_connection(self):
         logger.log_debug("District connected.")
-        self.send_raw_message("AUTH#{}".format(self.server.config["district_password"]))
-        while True:
-            data = await self.reader.readuntil(b"\r\n")
-            if not data:
-                return
-            raw_msg = data.decode()[:-2]
-            logger.log_debug("[DISTRICT][INC][RAW]{}".format(raw_msg))
-            cmd, *args = raw_msg.split("#")
-            if cmd == "GLOBAL":
-                glob_name = "{}[{}:{}][{}]".format(
-                    "<dollar>G", args[1], args[2], args[3]
-                )
-                if args[0] == "1":
-                    glob_name += "[M]"
-                self.server.send_all_cmd_pred(
-                    "CT", glob_name, args[4], pred=lambda x: not x.muted_global
-                )
-            elif cmd == "NEED":
-                need_msg = "=== Cross Advert ===\r\n{} at {} in {} [{}] needs {}\r\n====================".format(
-                    args[1], args[0], args[2], args[3], args[4]
-                )
-                self.server.send_all_cmd_pred(
-                    "CT",
-                    "{}".format(self.server.config["hostname"]),
-                    need_msg,
-                    pred=lambda x: not x.muted_adverts,
-                )
+        self.writer.write(
+            "AUTH#{}\r\n".format(self.server.config["district_password"]).encode()
+        )
+        write_task = asyncio.ensure_future(self.write_queue(self.writer))
+        try:
+            while True:
+                data = await self.reader.readuntil(b"\r\n")
+                try:
+                    self.handle_message(data.decode()[:-2])
+                except (IndexError, ValueError) as ex:
+                    logger.log_debug(
+                        "Malformed district message {!r}: {}".format(data, ex)
+                    )
+        finally:
+            write_task.cancel()
+
+    def handle_message(self, raw_msg):
+        logger.log_debug("[DISTRICT][INC][RAW]{}".format(raw_msg))
+        cmd, args = decode_command(raw_msg)
+        if cmd == "GLOBAL":
+            glob_name = "{}[{}:{}][{}]".format("<dollar>G", args[1], args[2], args[3])
+            if args[0] == "1":
+                glob_name += "[M]"
+            self.server.send_cmd_to(
+                self.server.client_manager.global_listeners, "CT", glob_name, args[4]
+            )
+        elif cmd == "NEED":
+            need_msg = "=== Cross Advert ===\r\n{} at {} in {} [{}] needs {}\r\n====================".format(
+                args[1], args[0], args[2], args[3], args[4]
+            )
+            self.server.send_cmd_to(
+                self.server.client_manager.advert_listeners,
+                "CT",
+                self.server.config["hostname"],
+                need_msg,
+            )
 
-    async def write_queue(self):
-        while self.message_queue:
-            msg = self.message_queue.pop(0)
+    async def write_queue(self, writer):
+        """ Writes queued messages, coalescing everything pending into one write.
+
+        The batch is only forgotten once written, so a batch interrupted by a
+        failed write or a lost connection is sent again on the next one.
+        """
+        while True:
+            if not self.unsent:
+                self.unsent.append(await self.queue.get())
+            while not self.queue.empty():
+                self.unsent.append(self.queue.get_nowait())
+            if len(self.unsent) > self.QUEUE_SIZE:
+                self.dropped += len(self.unsent) - self.QUEUE_SIZE
+                del self.unsent[: -self.QUEUE_SIZE]
             try:
-                self.writer.write(msg)
-                await self.writer.drain()
-            except ConnectionResetError:
+                writer.write(b"".join(self.unsent))
+                await writer.drain()
+            except OSError:
                 return
+            self.unsent = []
+
+    def send_command(self, command, *args):
+        """ Sends a district message, escaping the # in its fields. """
+        self.send_raw_message("#".join([command, *[escape(str(x)) for x in args]]))
 
     def send_raw_message(self, msg):
-        if not self.writer:
-            return
-        self.message_queue.append("{}\r\n".format(msg).encode())
-        asyncio.ensure_future(self.write_queue(), loop=asyncio.get_event_loop())
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait("{}\r\n".format(msg).encode())
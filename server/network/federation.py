@@ -0,0 +1,109 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" The wire format shared by the federation hub and its nodes.
+
+Every frame is a fixed header followed by a body:
+
+    <body length:u32><type:u8><node:u16><seq:u64><body>
+
+The body is a list of UTF-8 fields separated by NUL bytes. node and seq
+identify the node that created the frame and its position in that node's
+stream, the hub relays frames unchanged, so receivers can drop duplicates
+by remembering the highest seq seen per node.
+"""
+
+import struct
+import time
+
+HEADER = struct.Struct("<IBHQ")
+SEPARATOR = b"\x00"
+MAX_BODY = 64 * 1024
+
+# node -> hub: password, then "<node>:<seq>" for the last frame seen per node
+HELLO = 0
+# hub -> node: the last seq the hub has from the node
+WELCOME = 1
+# as_mod, area id, char name, message, server name
+GLOBAL = 2
+# char name, area name, area id, message, server name
+NEED = 3
+# mod call description, server name
+MODCALL = 4
+# ip
+BAN = 5
+
+RELAYED = (GLOBAL, NEED, MODCALL, BAN)
+
+
+class FrameError(Exception):
+    pass
+
+
+def initial_seq():
+    """ The first seq of a node, microseconds since the epoch.
+
+    This keeps seqs increasing across node restarts, so frames of a
+    restarted node aren't mistaken for duplicates of its previous run.
+    """
+    return time.time_ns() // 1000
+
+
+def encode_frame(frame_type, node, seq, *fields):
+    body = SEPARATOR.join(str(field).encode("utf-8") for field in fields)
+    if len(body) > MAX_BODY:
+        raise FrameError("Frame body too large.")
+    return HEADER.pack(len(body), frame_type, node, seq) + body
+
+
+def decode_fields(body):
+    if not body:
+        return []
+    return body.decode("utf-8", "replace").split("\x00")
+
+
+async def read_frame(reader):
+    """ Reads one frame from a stream.
+
+    :return: (type, node, seq, fields, raw frame bytes)
+    """
+    header = await reader.readexactly(HEADER.size)
+    length, frame_type, node, seq = HEADER.unpack(header)
+    if length > MAX_BODY:
+        raise FrameError("Frame body too large.")
+    body = await reader.readexactly(length)
+    return frame_type, node, seq, decode_fields(body), header + body
+
+
+def decode_int(field):
+    """ Parses a numeric field, raising FrameError if it isn't one. """
+    try:
+        return int(field)
+    except ValueError:
+        raise FrameError("Invalid number: {!r}".format(field))
+
+
+def encode_last_seen(last_seen):
+    return ["{}:{}".format(node, seq) for node, seq in last_seen.items()]
+
+
+def decode_last_seen(fields):
+    last_seen = {}
+    for field in fields:
+        node, _, seq = field.partition(":")
+        last_seen[decode_int(node)] = decode_int(seq)
+    return last_seen
@@ -0,0 +1,157 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+
+from server.network import federation
+from server.network.backoff import Backoff
+from server.network.federation import FrameError
+from server.util import logger
+
+
+class FederationClient:
+    """ The link to the federation hub, sharing global chat, adverts,
+    mod calls and bans with the other nodes.
+
+    Sent frames are kept in a bounded backlog. After reconnecting, the hub
+    reports the last seq it has from this node and everything newer is
+    resent, while frames from other nodes are deduplicated by their seq.
+    """
+
+    BACKLOG_SIZE = 1024
+
+    def __init__(self, server):
+        self.server = server
+        self.node = server.config["federation_node_id"]
+        self.reader = None
+        self.writer = None
+        self.backoff = Backoff()
+        self.seq = federation.initial_seq()
+        self.backlog = deque(maxlen=self.BACKLOG_SIZE)
+        self.last_seen = {}
+        self.duplicates = 0
+
+    async def connect(self):
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.server.config["federation_ip"],
+                    self.server.config["federation_port"],
+                )
+                await self.handle_connection()
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            except FrameError as ex:
+                logger.log_debug("[FEDERATION]{}".format(ex))
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+            self.reader = None
+            delay = self.backoff.next_delay()
+            logger.log_debug(
+                "Federation hub disconnected, retrying in {:.1f} seconds.".format(delay)
+            )
+            await asyncio.sleep(delay)
+
+    async def handle_connection(self):
+        writer = self.writer
+        writer.write(
+            federation.encode_frame(
+                federation.HELLO,
+                self.node,
+                0,
+                self.server.config["federation_password"],
+                *federation.encode_last_seen(self.last_seen),
+            )
+        )
+        frame_type, _, _, fields, _ = await federation.read_frame(self.reader)
+        if frame_type != federation.WELCOME or not fields:
+            raise FrameError("Expected WELCOME.")
+        print(logger.log_debug("Federation hub connected."))
+        self.backoff.reset()
+
+        acked = federation.decode_int(fields[0])
+        for seq, frame in self.backlog:
+            if seq > acked:
+                writer.write(frame)
+
+        while True:
+            frame_type, node, seq, fields, _ = await federation.read_frame(self.reader)
+            if seq <= self.last_seen.get(node, 0):
+                self.duplicates += 1
+                continue
+            self.last_seen[node] = seq
+            self.handle_frame(frame_type, fields)
+
+    def handle_frame(self, frame_type, fields):
+        logger.log_debug("[FEDERATION][INC]{}#{}".format(frame_type, "#".join(fields)))
+        try:
+            if frame_type == federation.GLOBAL:
+                as_mod, area_id, char_name, msg, server_name = fields
+                self.server.receive_global(
+                    server_name, area_id, char_name, msg, as_mod == "1"
+                )
+            elif frame_type == federation.NEED:
+                char_name, area_name, area_id, msg, server_name = fields
+                self.server.receive_need(
+                    server_name, char_name, area_name, area_id, msg
+                )
+            elif frame_type == federation.MODCALL:
+                text, server_name = fields
+                self.server.receive_modcall(server_name, text)
+            elif frame_type == federation.BAN:
+                (ip,) = fields
+                self.server.receive_ban(ip)
+        except ValueError:
+            logger.log_debug(
+                "[FEDERATION]Malformed frame of type {}.".format(frame_type)
+            )
+
+    def send_frame(self, frame_type, *fields):
+        self.seq += 1
+        frame = federation.encode_frame(frame_type, self.node, self.seq, *fields)
+        self.backlog.append((self.seq, frame))
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(frame)
+
+    def send_global(self, client, msg, as_mod):
+        self.send_frame(
+            federation.GLOBAL,
+            int(as_mod),
+            client.area.id,
+            client.get_char_name(),
+            msg,
+            self.server.config["federation_name"],
+        )
+
+    def send_need(self, client, msg):
+        area = client.area
+        self.send_frame(
+            federation.NEED,
+            client.get_char_name(),
+            area.name,
+            area.id,
+            msg,
+            self.server.config["federation_name"],
+        )
+
+    def send_modcall(self, text):
+        self.send_frame(federation.MODCALL, text, self.server.config["federation_name"])
+
+    def send_ban(self, ip):
+        self.send_frame(federation.BAN, ip)
@@ -0,0 +1,126 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hmac
+import time
+from collections import deque
+
+from server.network import federation
+from server.network.federation import FrameError
+
+
+def log(msg):
+    print("[{} UTC]{}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()), msg))
+
+
+class FederationHub:
+    """ Relays frames between the nodes of a federation.
+
+    The hub remembers the last REPLAY_SIZE relayed frames, a node that
+    reconnects tells the hub what it has seen and gets the frames it
+    missed replayed. Frames a node resends after reconnecting are dropped
+    by their seq, as are frames that don't come from the sending node.
+    """
+
+    REPLAY_SIZE = 1024
+    HELLO_TIMEOUT = 10
+    # nodes whose unsent data exceeds this are disconnected, they catch up on reconnect
+    WRITE_BUFFER_LIMIT = 1024 * 1024
+
+    def __init__(self, password):
+        self.password = password.encode("utf-8")
+        self.nodes = {}
+        self.last_seq = {}
+        self.backlog = deque(maxlen=self.REPLAY_SIZE)
+        self.relayed = 0
+        self.duplicates = 0
+
+    async def handle_node(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        node = None
+        try:
+            frame_type, node, _, fields, _ = await asyncio.wait_for(
+                federation.read_frame(reader), self.HELLO_TIMEOUT
+            )
+            if frame_type != federation.HELLO or not fields:
+                raise FrameError("Expected HELLO.")
+            if not hmac.compare_digest(fields[0].encode("utf-8"), self.password):
+                log("[{}]Rejected node {}, wrong password.".format(peer, node))
+                node = None
+                return
+            last_seen = federation.decode_last_seen(fields[1:])
+
+            old = self.nodes.get(node)
+            if old is not None:
+                old.close()
+            self.nodes[node] = writer
+            log("[{}]Node {} connected.".format(peer, node))
+
+            writer.write(
+                federation.encode_frame(
+                    federation.WELCOME, 0, 0, self.last_seq.get(node, 0)
+                )
+            )
+            self.replay(writer, node, last_seen)
+
+            while True:
+                frame_type, origin, seq, _, raw = await federation.read_frame(reader)
+                if frame_type not in federation.RELAYED or origin != node:
+                    log("[{}]Skipped unexpected frame from node {}.".format(peer, node))
+                    continue
+                self.relay(origin, seq, raw)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except FrameError as ex:
+            log("[{}]{}".format(peer, ex))
+        finally:
+            if node is not None and self.nodes.get(node) is writer:
+                del self.nodes[node]
+                log("[{}]Node {} disconnected.".format(peer, node))
+            writer.close()
+
+    def replay(self, writer, node, last_seen):
+        replayed = 0
+        for origin, seq, raw in self.backlog:
+            if origin != node and seq > last_seen.get(origin, 0):
+                writer.write(raw)
+                replayed += 1
+        if replayed:
+            log("Replayed {} frame(s) to node {}.".format(replayed, node))
+
+    def relay(self, origin, seq, raw):
+        if seq <= self.last_seq.get(origin, 0):
+            self.duplicates += 1
+            return
+        self.last_seq[origin] = seq
+        self.backlog.append((origin, seq, raw))
+        self.relayed += 1
+        for node, writer in list(self.nodes.items()):
+            if node == origin:
+                continue
+            if writer.transport.get_write_buffer_size() > self.WRITE_BUFFER_LIMIT:
+                log("Node {} is too slow, disconnecting.".format(node))
+                writer.close()
+                continue
+            writer.write(raw)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_node, host, port)
+        log("Federation hub listening on {}:{}.".format(host, port))
+        async with server:
+            await server.serve_forever()
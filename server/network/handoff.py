@@ -0,0 +1,164 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Handing listening sockets over to a new server process.
+
+A running server listens on a Unix socket. A new process connects and
+sends TAKEOVER, the old one replies with the names of its listening
+sockets as JSON and passes the sockets themselves along with SCM_RIGHTS.
+Once the new process is accepting on them, it sends READY, the old one
+removes its Unix socket, hands over shared state like the area store,
+replies DONE and stops accepting, while its existing connections stay up
+until they leave or the drain deadline. The new process only opens the
+shared state after DONE.
+"""
+
+import array
+import asyncio
+import json
+import os
+import socket
+
+from server.util import logger
+
+TAKEOVER = b"TAKEOVER"
+READY = b"READY"
+DONE = b"DONE"
+
+MAX_SOCKETS = 8
+TIMEOUT = 10
+
+
+class Handoff:
+    """ The new process' end of a handoff, holding the received sockets. """
+
+    def __init__(self, conn, sockets):
+        self.conn = conn
+        self.sockets = sockets
+
+    def ready(self):
+        """ Tells the old process we're accepting, returns once it has stopped. """
+        try:
+            self.conn.sendall(READY)
+            self.conn.recv(len(DONE))
+        except OSError as ex:
+            # the sockets are ours already, carry on without the old process' DONE
+            print(
+                logger.log_debug("No reply to READY from the old server: {}".format(ex))
+            )
+        finally:
+            self.conn.close()
+
+
+def take_over(path):
+    """ Asks the server listening on path for its listening sockets.
+
+    :param path: path of the handoff Unix socket
+    :return: a Handoff, or None if no server is listening there or it
+        didn't hand its sockets over, the caller then binds its own
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(TIMEOUT)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+
+    fds = array.array("i")
+    try:
+        conn.sendall(TAKEOVER)
+        msg, ancdata, _, _ = conn.recvmsg(
+            4096, socket.CMSG_LEN(MAX_SOCKETS * fds.itemsize)
+        )
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[: len(data) - (len(data) % fds.itemsize)])
+        names = json.loads(msg.decode("utf-8"))
+        if not isinstance(names, list) or len(names) != len(fds):
+            raise ValueError("Expected a name for each of {} sockets.".format(len(fds)))
+    except (OSError, ValueError) as ex:
+        # a wedged or already draining server, or one that closed without replying
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+        print(logger.log_debug("Socket handoff failed, binding instead: {}".format(ex)))
+        return None
+    sockets = {name: socket.socket(fileno=fd) for name, fd in zip(names, fds)}
+    return Handoff(conn, sockets)
+
+
+class HandoffListener:
+    """ Waits for a new process and hands it the listening sockets.
+
+    :param path: path of the handoff Unix socket
+    :param sockets: dict of name -> listening socket
+    :param on_ready: called once the new process accepts, before it's told to go on
+    :param on_handoff: called once the new process has taken over
+    """
+
+    def __init__(self, path, sockets, on_ready, on_handoff):
+        self.path = path
+        self.sockets = sockets
+        self.on_ready = on_ready
+        self.on_handoff = on_handoff
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.sock.setblocking(False)
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self.sock)
+            try:
+                if await self.hand_over(loop, conn):
+                    break
+            except (OSError, asyncio.TimeoutError) as ex:
+                logger.log_debug("Socket handoff failed: {}".format(ex))
+            finally:
+                conn.close()
+        self.on_handoff()
+
+    async def hand_over(self, loop, conn):
+        request = await asyncio.wait_for(loop.sock_recv(conn, len(TAKEOVER)), TIMEOUT)
+        if request != TAKEOVER:
+            return False
+        names = list(self.sockets)
+        fds = array.array("i", [self.sockets[name].fileno() for name in names])
+        conn.sendmsg(
+            [json.dumps(names).encode("utf-8")],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+        )
+        reply = await asyncio.wait_for(loop.sock_recv(conn, len(READY)), TIMEOUT)
+        if reply != READY:
+            return False
+        self.close()
+        self.on_ready()
+        await loop.sock_sendall(conn, DONE)
+        return True
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -17,70 +17,123 @@
 
 
 import asyncio
+import time
 
+from server.network.backoff import Backoff
+from server.network.codec import decode_command, encode_command, escape
 from server.util import logger
 
+CHECK = b"CHECK#%"
+PONG = b"PONG#%"
+PING = b"PING#%"
+
 
 class MasterServerClient:
+    """ Advertises the server on the master server.
+
+    Besides the SCC server info, the current player count is pushed as
+    PC#<players>#<playerlimit>#% whenever it changes, at most once every
+    PLAYER_COUNT_INTERVAL seconds, so join/leave bursts collapse into
+    a single update.
+    """
+
+    PLAYER_COUNT_INTERVAL = 5.0
+
     def __init__(self, server):
         self.server = server
         self.reader = None
         self.writer = None
+        self.backoff = Backoff()
+        self.server_info = self.build_server_info()
+        self.sent_player_count = None
+        self.last_player_count_time = 0.0
+        self.player_count_handle = None
 
     async def connect(self):
-        loop = asyncio.get_event_loop()
         while True:
             try:
                 self.reader, self.writer = await asyncio.open_connection(
                     self.server.config["masterserver_ip"],
                     self.server.config["masterserver_port"],
-                    loop=loop,
                 )
+                self.backoff.reset()
                 await self.handle_connection()
-            except (ConnectionRefusedError, TimeoutError):
+            except (OSError, asyncio.IncompleteReadError):
                 pass
-            except (ConnectionResetError, asyncio.IncompleteReadError):
-                self.writer = None
-                self.reader = None
-            finally:
-                logger.log_debug(
-                    "Couldn't connect to the master server, retrying in 30 seconds."
-                )
-                await asyncio.sleep(30)
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+            self.reader = None
+            delay = self.backoff.next_delay()
+            logger.log_debug(
+                "Master server disconnected, retrying in {:.1f} seconds.".format(delay)
+            )
+            await asyncio.sleep(delay)
 
     async def handle_connection(self):
         print(logger.log_debug("Master server connected."))
 
-        await self.send_server_info()
+        self.send_server_info()
         while True:
             data = await self.reader.readuntil(b"#%")
-            if not data:
-                return
-            raw_msg = data.decode()[:-2]
-            cmd, *args = raw_msg.split("#")
-            if cmd != "CHECK" and cmd != "PONG":
-                logger.log_debug("[MASTERSERVER][INC][RAW]{}".format(raw_msg))
-            if cmd == "CHECK":
-                await self.send_raw_message("PING#%")
-            elif cmd == "NOSERV":
-                await self.send_server_info()
-
-    async def send_server_info(self):
+            # heartbeats are by far the most common, so answer them without decoding
+            if data == CHECK:
+                self.send_raw_message(PING)
+                continue
+            if data == PONG:
+                continue
+            raw_msg = data[:-2].decode("utf-8", "ignore")
+            logger.log_debug("[MASTERSERVER][INC][RAW]{}".format(raw_msg))
+            cmd, args = decode_command(raw_msg)
+            if cmd == "NOSERV":
+                self.send_server_info()
+
+    def build_server_info(self):
         cfg = self.server.config
         port = str(cfg["port"])
         if cfg["use_websockets"]:
             port += "&{}".format(cfg["websocket_port"])
-        msg = "SCC#{}#{}#{}#{}#%".format(
+        return encode_command(
+            "SCC",
             port,
-            cfg["masterserver_name"],
-            cfg["masterserver_description"],
+            escape(cfg["masterserver_name"]),
+            escape(cfg["masterserver_description"]),
             self.server.software,
         )
-        await self.send_raw_message(msg)
 
-    async def send_raw_message(self, msg):
-        try:
-            self.writer.write(msg.encode())
-            await self.writer.drain()
-        except ConnectionResetError:
+    def send_server_info(self):
+        self.send_raw_message(self.server_info)
+        self.sent_player_count = None
+        self.send_player_count()
+
+    def player_count_changed(self):
+        """ Schedules a player count update, unless one is already pending. """
+        if self.player_count_handle is not None:
+            return
+        delay = max(
+            0.0,
+            self.last_player_count_time + self.PLAYER_COUNT_INTERVAL - time.monotonic(),
+        )
+        self.player_count_handle = asyncio.get_event_loop().call_later(
+            delay, self.send_player_count
+        )
+
+    def send_player_count(self):
+        if self.player_count_handle is not None:
+            self.player_count_handle.cancel()
+            self.player_count_handle = None
+        if self.writer is None:
+            return
+        count = self.server.get_player_count()
+        if count == self.sent_player_count:
+            return
+        self.sent_player_count = count
+        self.last_player_count_time = time.monotonic()
+        self.send_raw_message(
+            encode_command("PC", count, self.server.config["playerlimit"])
+        )
+
+    def send_raw_message(self, data):
+        if self.writer is None or self.writer.is_closing():
             return
+        self.writer.write(data)
@@ -31,7 +31,15 @@ class NetworkInterface:
         self.transport.close()
 
     def send_raw_message(self, message):
-        self.transport.write(message.encode("utf-8"))
+        return self.send_raw_bytes(message.encode("utf-8"))
+
+    def send_raw_bytes(self, data):
+        self.transport.write(data)
+        return len(data)
+
+    def get_write_buffer_size(self):
+        """ Bytes written but not yet sent. """
+        return self.transport.get_write_buffer_size()
 
     def get_ip(self):
         return self.transport.get_extra_info("peername")[0]
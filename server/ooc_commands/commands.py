@@ -17,9 +17,15 @@
 import random
 
 from server.ooc_commands.argument_types import Type, Flag
-from server.ooc_commands.decorators import arguments, casing_area_only, mod_only
+from server.ooc_commands.decorators import (
+    aliases,
+    arguments,
+    casing_area_only,
+    mod_only,
+)
 from server.util import logger
-from server.util.exceptions import ClientError, AreaError, ArgumentError, ServerError
+from server.util.exceptions import ClientError, AreaError, ArgumentError
+from server.util.perf import PerfStats
 
 
 @arguments()
@@ -196,13 +202,14 @@ def ooc_cmd_getarea(client, id):
 
 @arguments(arg=(Type.String, [Flag.Multiword]))
 def ooc_cmd_pm(client, arg):
-    spl = arg.split(":", maxsplit=1)
-    if len(spl) != 2:
+    target_clients, msg = client.server.client_manager.get_targets_and_message(
+        client, arg
+    )
+    if not msg:
         raise ArgumentError("Bad format. Syntax: /pm target: message")
-    spl = [x.strip() for x in spl]
-    target, msg = spl
-
-    target_clients = client.server.client_manager.get_targets(client, target)
+    msg = client.server.filter_text(client, msg)
+    if msg is None:
+        raise ClientError("Your message was blocked.")
     if not target_clients:
         client.send_host_message("No targets found.")
     else:
@@ -218,7 +225,10 @@ def ooc_cmd_pm(client, arg):
             )
         logger.log_server(
             "[{}][{}]Sent PM to {}: {}".format(
-                client.area.id, client.get_char_name(), target, msg
+                client.area.id,
+                client.get_char_name(),
+                ", ".join(c.get_char_name() for c in target_clients),
+                msg,
             ),
             client,
         )
@@ -259,6 +269,9 @@ def ooc_cmd_coinflip(client):
 
 @arguments(text=(Type.String, [Flag.Multiword]))
 def ooc_cmd_g(client, text):
+    text = client.server.filter_text(client, text)
+    if text is None:
+        raise ClientError("Your message was blocked.")
     client.server.broadcast_global(client, text)
     logger.log_server(
         "[{}][{}][GLOBAL]{}.".format(client.area.id, client.get_char_name(), text),
@@ -306,19 +319,60 @@ def ooc_cmd_unmute(client, arg):
 
 
 @mod_only
+@aliases("ipban")
 @arguments(ip=Type.String)
 def ooc_cmd_banip(client, ip):
     ip = ip.strip()
     if len(ip) < 7:
         raise ArgumentError("You must specify an IP.")
-    try:
-        client.server.ban_manager.add_ban(ip)
-    except ServerError:
-        raise
-    targets = client.server.client_manager.get_targets_by_ip(ip)
-    if targets:
-        for c in targets:
-            c.disconnect()
-        client.send_host_message("Kicked {} existing client(s).".format(len(targets)))
+    kicked = client.server.ban_ip(ip)
+    if kicked:
+        client.send_host_message("Kicked {} existing client(s).".format(kicked))
     client.send_host_message("Added {} to the banlist.".format(ip))
     logger.log_server("Banned {}.".format(ip), client)
+
+
+@mod_only
+@arguments(action=(Type.String, [Flag.Optional]))
+def ooc_cmd_perf(client, action):
+    if action in (None, PerfStats.NET, PerfStats.OOC, "icq", "flood"):
+        client.send_host_message(client.server.get_perf_report(action))
+    elif action == "reset":
+        client.server.perf.reset()
+        if client.server.flood_guard:
+            client.server.flood_guard.reset()
+        client.send_host_message("Performance statistics reset.")
+        logger.log_server("Reset performance statistics.", client)
+    else:
+        raise ArgumentError("Usage: /perf [net|ooc|icq|flood|reset]")
+
+
+@mod_only
+@arguments(seconds=Type.Integer)
+def ooc_cmd_profile(client, seconds):
+    path_base = client.server.start_profile(seconds, client)
+    client.send_host_message(
+        "Profiling for {} seconds, writing to {}.".format(seconds, path_base)
+    )
+    logger.log_server("Started a {} second profile.".format(seconds), client)
+
+
+@mod_only
+@arguments(action=(Type.String, [Flag.Optional]))
+def ooc_cmd_memory(client, action):
+    tracer = client.server.memory_tracer
+    if action is None:
+        client.send_host_message(client.server.get_memory_report())
+    elif action == "start":
+        tracer.start()
+        client.send_host_message("Memory tracing started.")
+        logger.log_server("Started memory tracing.", client)
+    elif action == "stop":
+        tracer.stop()
+        client.send_host_message("Memory tracing stopped.")
+        logger.log_server("Stopped memory tracing.", client)
+    elif action == "snapshot":
+        path_base = client.server.take_memory_snapshot(client)
+        client.send_host_message("Writing a memory snapshot to {}.".format(path_base))
+    else:
+        raise ArgumentError("Usage: /memory [start|snapshot|stop]")
@@ -16,100 +16,74 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
-These decorators serve to avoid code repetition in common OOC command checks.
+These decorators describe OOC commands: their arguments, who may use them
+and where. They don't wrap the command function, they only attach a
+CommandSpec to it, which the registry turns into a Command at import time.
 
-Note the order of the decorators matters, typically the message to be sent
-to be user will be the outermost failing decorator.
+The order of the decorators does not matter, permission checks always run
+before area checks, which run before argument parsing.
 """
 
-import functools
-
 from server.ooc_commands.argument_types import Flag, Type
-from server.util.exceptions import ClientError, ArgumentError, AreaError
 
 
-def mod_only(f):
-    """ Command requires you to be logged in as a moderator. """
+class CommandSpec:
+    """ Metadata collected from the decorators of a single OOC command. """
+
+    def __init__(self):
+        self.arguments = ()
+        self.aliases = ()
+        self.mod_only = False
+        self.casing_area_only = False
+
 
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        client = args[0]
-        if not client.get_attr("is_moderator"):
-            raise ClientError("You must be logged in as a moderator to do that.")
-        return f(*args, **kwargs)
+def get_spec(f):
+    """ Returns the CommandSpec of a function, creating it if needed. """
+    try:
+        return f.ooc_spec
+    except AttributeError:
+        f.ooc_spec = CommandSpec()
+        return f.ooc_spec
 
-    return wrapper
+
+def mod_only(f):
+    """ Command requires you to be logged in as a moderator. """
+    get_spec(f).mod_only = True
+    return f
 
 
 def casing_area_only(f):
     """ Command can only be used in a casing area. """
+    get_spec(f).casing_area_only = True
+    return f
+
+
+def aliases(*names):
+    """ Alternative names the command can be invoked with. """
 
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        client = args[0]
-        if not client.area.get_attr("is_casing"):
-            raise AreaError("This area is not intended for casing.")
-        return f(*args, **kwargs)
+    def aliases_func(f):
+        get_spec(f).aliases = names
+        return f
 
-    return wrapper
+    return aliases_func
 
 
 def arguments(**arg_kwargs):
-    def parse_argument(string, arg_type, multiword):
-        rest = ""
-        if multiword:
-            arg = string
-        else:
-            spl = string.split(maxsplit=1)
-            arg = spl[0]
-            if len(spl) == 2:
-                rest = spl[1]
-
-        if arg_type == Type.Integer:
-            try:
-                val = int(arg)
-                return val, rest
-            except ValueError:
-                raise ArgumentError("Expected a numeric argument.")
-        else:
-            return arg, rest
+    """ Declares the command's arguments in order.
+
+    Each keyword maps an argument name to either its Type,
+    or a (Type, [Flag, ...]) pair.
+    """
+    plan = []
+    for name, value in arg_kwargs.items():
+        flags = ()
+        if isinstance(value, (list, tuple)):
+            value, flags = value
+        convert = int if value == Type.Integer else None
+        plan.append((name, convert, Flag.Optional in flags, Flag.Multiword in flags))
 
     def arguments_func(f):
-        @functools.wraps(f)
-        def wrapper(client, cmd_arg):
-            parsed_args = dict()
-
-            rest_cmd_arg = cmd_arg
-            for name, value in arg_kwargs.items():
-                optional = False
-                multiword = False
-                if isinstance(value, (list, tuple)):
-                    arg_type, flags = value
-                    optional = Flag.Optional in flags
-                    multiword = Flag.Multiword in flags
-                else:
-                    arg_type = value
-
-                if not rest_cmd_arg:
-                    if not optional:
-                        raise ArgumentError("Not enough arguments.")
-                    else:
-                        parsed_args[name] = None
-                        continue
-
-                try:
-                    arg_val, rest_cmd_arg = parse_argument(
-                        rest_cmd_arg, arg_type, multiword
-                    )
-                    parsed_args[name] = arg_val
-                except ArgumentError:
-                    raise
-
-            if rest_cmd_arg:
-                raise ArgumentError("Too many arguments.")
-
-            return f(client, **parsed_args)
-
-        return wrapper
+        get_spec(f).arguments = tuple(plan)
+        return f
 
     return arguments_func
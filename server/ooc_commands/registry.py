@@ -0,0 +1,104 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from server.ooc_commands import commands, legacy_commands
+from server.ooc_commands.decorators import get_spec
+from server.util.exceptions import ClientError, AreaError, ArgumentError
+
+PREFIX = "ooc_cmd_"
+
+
+class Command:
+    """ An OOC command with its argument parser compiled ahead of time. """
+
+    def __init__(self, name, func):
+        spec = get_spec(func)
+        self.name = name
+        self.func = func
+        self.aliases = spec.aliases
+        self.mod_only = spec.mod_only
+        self.casing_area_only = spec.casing_area_only
+        self.plan = spec.arguments
+
+    def parse(self, cmd_arg):
+        """ Parses the raw argument string into keyword arguments.
+
+        :param cmd_arg: everything after the command name
+        :return: dict of argument name -> value
+        """
+        parsed = {}
+        rest = cmd_arg
+        for name, convert, optional, multiword in self.plan:
+            if multiword:
+                arg, rest = rest, ""
+            else:
+                spl = rest.split(maxsplit=1)
+                arg = spl[0] if spl else ""
+                rest = spl[1] if len(spl) == 2 else ""
+
+            if not arg:
+                if not optional:
+                    raise ArgumentError("Not enough arguments.")
+                parsed[name] = None
+                continue
+
+            if convert is not None:
+                try:
+                    arg = convert(arg)
+                except ValueError:
+                    raise ArgumentError("Expected a numeric argument.")
+            parsed[name] = arg
+
+        if rest:
+            raise ArgumentError("Too many arguments.")
+        return parsed
+
+    def __call__(self, client, cmd_arg):
+        if self.mod_only and not client.get_attr("is_moderator"):
+            raise ClientError("You must be logged in as a moderator to do that.")
+        if self.casing_area_only and not client.area.get_attr("is_casing"):
+            raise AreaError("This area is not intended for casing.")
+        return self.func(client, **self.parse(cmd_arg))
+
+
+class CommandRegistry:
+    """ Maps command names and aliases to their Command. """
+
+    def __init__(self):
+        self.commands = {}
+
+    def register_module(self, module):
+        """ Registers every ooc_cmd_* function of a module.
+
+        Names that are already registered are skipped, so modules
+        registered earlier take precedence.
+        """
+        for attr, func in vars(module).items():
+            if not attr.startswith(PREFIX) or not callable(func):
+                continue
+            cmd = Command(attr[len(PREFIX) :], func)
+            for name in (cmd.name,) + cmd.aliases:
+                self.commands.setdefault(name, cmd)
+
+    def get_command(self, name):
+        """ Returns the Command for a name or alias, None if there is none. """
+        return self.commands.get(name)
+
+
+registry = CommandRegistry()
+registry.register_module(commands)
+registry.register_module(legacy_commands)
@@ -16,40 +16,88 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import os
+import signal
+import time
 
 import websockets
 import yaml
 
 from server.areas.area_manager import AreaManager
 from server.clients.client_manager import ClientManager
+from server.data.area_store import AreaStore
 from server.data.ban_manager import BanManager
+from server.data.io_service import IOService
 from server.network.ao_protocol import AOProtocol
 from server.network.ao_protocol_ws import new_websocket_client
+from server.network.capture import TrafficCapture
+from server.network.codec import encode_command
 from server.network.district_client import DistrictClient
+from server.network.federation_client import FederationClient
+from server.network.handoff import HandoffListener, take_over
 from server.network.master_server_client import MasterServerClient
 from server.util import logger
 from server.util.constants import SOFTWARE, SOFTWARE_VERSION
+from server.util.content_filter import load_filter
 from server.util.exceptions import ServerError
+from server.util.flood_guard import FloodGuard
+from server.util.memory import MemoryTracer, render_report
+from server.util.name_trie import NameTrie
+from server.util.perf import PerfStats
+from server.util.profiler import SamplingProfiler
 
 
 class TsuServer3:
     def __init__(self):
+        self.config = None
+        self.load_config()
         self.client_manager = ClientManager(self)
         self.area_manager = AreaManager(self)
-        self.ban_manager = BanManager()
+        self.io = IOService(self.config.get("io_threads", 2))
+        self.ban_manager = BanManager(self.io)
+        self.perf = PerfStats()
+        self.profiler = SamplingProfiler(self.config.get("profile_interval", 0.005))
+        self.memory_tracer = MemoryTracer(self.config.get("tracemalloc_frames", 10))
+        self.flood_guard = None
+        if self.config.get("use_flood_guard", False):
+            self.flood_guard = FloodGuard(
+                self.config.get("flood_window", 10),
+                self.config.get("flood_window_size", 8),
+                {
+                    scope: self.config[key]
+                    for scope, key in (
+                        ("client", "flood_client_repeats"),
+                        ("ip", "flood_ip_repeats"),
+                        ("area", "flood_area_repeats"),
+                    )
+                    if key in self.config
+                },
+                self.config.get("flood_min_length", 8),
+                self.config.get("flood_action", "drop") == "drop",
+            )
         self.software = SOFTWARE
         self.software_version = SOFTWARE_VERSION
         self.char_list = None
+        self.char_trie = None
         self.music_list = None
         self.music_list_network = None
         self.backgrounds = None
-        self.config = None
-        self.load_config()
+        self.content_filter = None
+        self.filter_mtime = None
         self.load_characters()
         self.load_music()
         self.load_backgrounds()
+        if self.config.get("use_filter", False):
+            self.load_filter()
+        self.area_store = None
         self.district_client = None
+        self.federation_client = None
         self.ms_client = None
+        self.capture = None
+        self.ao_server = None
+        self.ws_server = None
+        self.handoff_listener = None
+        self.link_tasks = []
         logger.setup_logger(debug=self.config["debug"])
 
     def start(self):
@@ -59,28 +107,89 @@ class TsuServer3:
         if self.config["local"]:
             bound_ip = "127.0.0.1"
 
-        ao_server_crt = loop.create_server(
-            lambda: AOProtocol(self), bound_ip, self.config["port"]
-        )
-        ao_server = loop.run_until_complete(ao_server_crt)
+        if self.config.get("use_capture", False):
+            self.capture = TrafficCapture(self.config["capture_file"])
+            print(
+                logger.log_debug("Capturing traffic to {}.".format(self.capture.path))
+            )
 
-        if self.config["use_websockets"]:
-            ao_server_ws = websockets.serve(
-                new_websocket_client(self), bound_ip, self.config["websocket_port"]
+        handoff_path = self.config.get("handoff_socket")
+        handoff = None
+        inherited = {}
+        if handoff_path:
+            handoff = take_over(handoff_path)
+            if handoff:
+                inherited = handoff.sockets
+
+        if "tcp" in inherited:
+            ao_server_crt = loop.create_server(
+                lambda: AOProtocol(self), sock=inherited["tcp"]
             )
-            asyncio.ensure_future(ao_server_ws)
+        else:
+            ao_server_crt = loop.create_server(
+                lambda: AOProtocol(self), bound_ip, self.config["port"]
+            )
+        self.ao_server = loop.run_until_complete(ao_server_crt)
+
+        if self.config["use_websockets"]:
+            if "ws" in inherited:
+                ao_server_ws = websockets.serve(
+                    new_websocket_client(self), sock=inherited["ws"]
+                )
+            else:
+                ao_server_ws = websockets.serve(
+                    new_websocket_client(self), bound_ip, self.config["websocket_port"]
+                )
+            self.ws_server = loop.run_until_complete(ao_server_ws)
             print(logger.log_debug("WebSocket support enabled."))
 
+        if handoff:
+            # returns once the old process stopped writing the area store
+            handoff.ready()
+            print(logger.log_debug("Took over the listening sockets."))
+        self.open_area_store()
+
+        if handoff_path:
+            listening = {"tcp": self.ao_server.sockets[0]}
+            if self.ws_server:
+                listening["ws"] = self.ws_server.server.sockets[0]
+            self.handoff_listener = HandoffListener(
+                handoff_path, listening, self.close_area_store, self.drain
+            )
+            asyncio.ensure_future(self.handoff_listener.serve())
+
         if self.config["use_district"]:
             self.district_client = DistrictClient(self)
-            asyncio.ensure_future(self.district_client.connect(), loop=loop)
+            self.link_tasks.append(
+                asyncio.ensure_future(self.district_client.connect(), loop=loop)
+            )
             print(logger.log_debug("District support enabled."))
 
+        if self.config.get("use_federation", False):
+            self.federation_client = FederationClient(self)
+            self.link_tasks.append(
+                asyncio.ensure_future(self.federation_client.connect(), loop=loop)
+            )
+            print(logger.log_debug("Federation support enabled."))
+
         if self.config["use_masterserver"]:
             self.ms_client = MasterServerClient(self)
-            asyncio.ensure_future(self.ms_client.connect(), loop=loop)
+            self.link_tasks.append(
+                asyncio.ensure_future(self.ms_client.connect(), loop=loop)
+            )
             print(logger.log_debug("Master server support enabled."))
 
+        if self.config.get("use_filter", False):
+            loop.call_later(
+                self.config.get("filter_reload_interval", 5), self.check_filter
+            )
+
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.dump_perf_stats)
+            loop.add_signal_handler(signal.SIGUSR2, self.profile_on_signal)
+            # shut down cleanly, so pending area state gets written
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
         print(logger.log_debug("Server started."))
 
         try:
@@ -90,21 +199,169 @@ class TsuServer3:
 
         logger.log_debug("Server shutting down.")
 
-        ao_server.close()
-        loop.run_until_complete(ao_server.wait_closed())
+        if self.handoff_listener:
+            self.handoff_listener.close()
+        self.ao_server.close()
+        loop.run_until_complete(self.ao_server.wait_closed())
         loop.close()
 
+        if self.capture:
+            self.capture.close()
+        self.close_area_store()
+        self.io.close()
+        logger.stop_logger()
+
+    def open_area_store(self):
+        if self.config.get("use_area_store", False):
+            self.area_store = AreaStore(self.config["area_store_file"])
+            self.area_manager.restore(self.area_store.load())
+
+    def close_area_store(self):
+        """ Writes pending area state and stops persisting it. """
+        if self.area_store:
+            self.area_store.close()
+            self.area_store = None
+
+    def drain(self):
+        """ Stops accepting and waits for the remaining clients to leave.
+
+        Used after handing the listening sockets to a new process. Clients
+        still connected after handoff_drain_timeout seconds are disconnected.
+        The area store was already closed when the new process took over, so
+        the new process owns it and changes made while draining aren't kept.
+        """
+        loop = asyncio.get_event_loop()
+        self.ao_server.close()
+        if self.ws_server:
+            # only stop listening, closing the WebSocketServer would drop its clients
+            self.ws_server.server.close()
+        for task in self.link_tasks:
+            task.cancel()
+        self.district_client = None
+        self.federation_client = None
+        self.ms_client = None
+
+        deadline = loop.time() + self.config.get("handoff_drain_timeout", 600)
+        print(
+            logger.log_debug(
+                "Handed off the listening sockets, draining {} client(s).".format(
+                    self.get_player_count()
+                )
+            )
+        )
+
+        def check():
+            if not self.client_manager.clients:
+                loop.stop()
+            elif loop.time() >= deadline:
+                for c in list(self.client_manager.clients):
+                    c.disconnect()
+                # give the transports a moment to close
+                loop.call_later(1, loop.stop)
+            else:
+                loop.call_later(1, check)
+
+        check()
+
     def new_client(self, transport):
         c = self.client_manager.new_client(
             transport, self.area_manager.get_default_area()
         )
         c.area.new_client(c)
+        if self.ms_client:
+            self.ms_client.player_count_changed()
         return c
 
     def remove_client(self, client):
         client.area.remove_client(client)
         self.client_manager.remove_client(client)
+        if self.flood_guard:
+            self.flood_guard.leave(client)
         self.send_arup_all()
+        if self.ms_client:
+            self.ms_client.player_count_changed()
+
+    def get_perf_report(self, kind=None):
+        if kind == "icq":
+            return self.area_manager.render_ic_queues()
+        if kind == "flood":
+            if self.flood_guard is None:
+                return "The flood guard is disabled."
+            return self.flood_guard.render()
+        report = self.perf.render(kind)
+        if kind is None:
+            report += "\r\n" + self.area_manager.render_ic_queues()
+            if self.flood_guard:
+                report += "\r\n" + self.flood_guard.render()
+        return report
+
+    def dump_perf_stats(self):
+        print(logger.log_server(self.get_perf_report()))
+
+    def start_profile(self, duration, client=None):
+        """ Profiles the event loop for duration seconds.
+
+        The results are written to logs/ and the top functions are sent to
+        client once done, or written to the server log without one.
+        """
+        loop = asyncio.get_event_loop()
+        path_base = os.path.join(
+            "logs", time.strftime("profile-%Y%m%d-%H%M%S", time.gmtime())
+        )
+
+        def done(profile):
+            # runs on the profiler thread, so writing the files doesn't block
+            try:
+                profile.write(path_base)
+                report = "{}\r\nWritten to {}.pstats and .folded.".format(
+                    profile.render(), path_base
+                )
+            except OSError as ex:
+                report = "Failed to write the profile: {}".format(ex)
+            loop.call_soon_threadsafe(self.send_report, client, report)
+
+        self.profiler.start(duration, done)
+        return path_base
+
+    def send_report(self, client, report):
+        """ Sends the result of a background report to the mod who asked for it. """
+        if client is not None and client in self.client_manager.clients:
+            client.send_host_message(report)
+        logger.log_server(report)
+
+    def profile_on_signal(self):
+        try:
+            path_base = self.start_profile(
+                self.config.get("profile_signal_seconds", 30)
+            )
+            print(logger.log_debug("Profiling to {}.".format(path_base)))
+        except ServerError as ex:
+            print(logger.log_debug(str(ex)))
+
+    def get_memory_report(self):
+        return render_report(self, self.memory_tracer)
+
+    def take_memory_snapshot(self, client=None):
+        """ Takes a tracemalloc snapshot and writes its diff to the previous one to logs/. """
+        loop = asyncio.get_event_loop()
+        previous, snapshot = self.memory_tracer.take_snapshot()
+        path_base = os.path.join(
+            "logs", time.strftime("memory-%Y%m%d-%H%M%S", time.gmtime())
+        )
+
+        def done(future):
+            try:
+                report = "{}\r\nWritten to {}.snapshot and .txt.".format(
+                    future.result(), path_base
+                )
+            except OSError as ex:
+                report = "Failed to write the memory snapshot: {}".format(ex)
+            loop.call_soon_threadsafe(self.send_report, client, report)
+
+        self.io.run(
+            self.memory_tracer.write_diff, previous, snapshot, path_base
+        ).add_done_callback(done)
+        return path_base
 
     def get_player_count(self):
         return len(self.client_manager.clients)
@@ -116,6 +373,7 @@ class TsuServer3:
     def load_characters(self):
         with open("config/characters.yaml", "r") as chars:
             self.char_list = yaml.load(chars, Loader=yaml.BaseLoader)
+        self.char_trie = NameTrie(self.char_list)
 
     def load_music(self):
         with open("config/music.yaml", "r") as music:
@@ -131,14 +389,116 @@ class TsuServer3:
         with open("config/backgrounds.yaml", "r") as bgs:
             self.backgrounds = yaml.load(bgs, Loader=yaml.BaseLoader)
 
+    def load_filter(self):
+        path = self.config.get("filter_file", "config/filter.yaml")
+        self.filter_mtime = os.stat(path).st_mtime
+        self.content_filter = load_filter(path)
+
+    def check_filter(self):
+        """ Reloads the content filter if its file changed, and checks again later.
+
+        Compiling thousands of terms takes a moment, so it's done on the I/O
+        pool and the new filter swapped in once it's ready. Until then, and
+        if the new file is invalid, the old filter stays in use.
+        """
+        loop = asyncio.get_event_loop()
+        path = self.config.get("filter_file", "config/filter.yaml")
+        interval = self.config.get("filter_reload_interval", 5)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = self.filter_mtime
+        if mtime == self.filter_mtime:
+            loop.call_later(interval, self.check_filter)
+            return
+
+        def done(future):
+            try:
+                content_filter = future.result()
+            except Exception as ex:
+                # anything from a missing file to a badly encoded term
+                content_filter = None
+                logger.log_server("Failed to reload {}: {!r}".format(path, ex))
+            loop.call_soon_threadsafe(swap, content_filter)
+
+        def swap(content_filter):
+            self.filter_mtime = mtime
+            if content_filter is not None:
+                self.content_filter = content_filter
+                logger.log_server(
+                    "Reloaded {}, {} terms.".format(path, content_filter.size)
+                )
+            loop.call_later(interval, self.check_filter)
+
+        self.io.run(load_filter, path).add_done_callback(done)
+
+    def filter_text(self, client, text):
+        """ Runs text a client sent through the content filter.
+
+        :return: the text with censored terms replaced, None if it's blocked
+        """
+        if self.content_filter is None:
+            return text
+        result = self.content_filter.apply(text)
+        if result.alerts:
+            self.send_cmd_to(
+                self.client_manager.moderators,
+                "ZZ",
+                "{} ({}) in {} ({}) said {}: {}".format(
+                    client.get_char_name(),
+                    client.get_ip(),
+                    client.area.name,
+                    client.area.id,
+                    ", ".join(result.alerts),
+                    text,
+                ),
+            )
+            logger.log_server(
+                "Filter alert ({}): {}".format(", ".join(result.alerts), text), client
+            )
+        if result.blocked:
+            logger.log_server("Filter blocked: {}".format(text), client)
+            return None
+        return result.text
+
+    def check_flood(self, client, command, text):
+        """ Runs a message through the flood guard before it's broadcast.
+
+        Moderators are told about the first copy over a limit, so a raid
+        doesn't flood them instead.
+
+        :return: False if the message must be dropped
+        """
+        if self.flood_guard is None or client.get_attr("is_moderator"):
+            return True
+        repeat = self.flood_guard.check(command, client, text)
+        if repeat is None:
+            return True
+        scope, first = repeat
+        if first:
+            self.send_cmd_to(
+                self.client_manager.moderators,
+                "ZZ",
+                "{} ({}) in {} ({}) is repeating a message ({}): {}".format(
+                    client.get_char_name(),
+                    client.get_ip(),
+                    client.area.name,
+                    client.area.id,
+                    scope,
+                    text,
+                ),
+            )
+            logger.log_server("Repeated message ({}): {}".format(scope, text), client)
+        return not self.flood_guard.drop
+
     def is_valid_char_id(self, char_id):
         return len(self.char_list) > char_id >= 0
 
     def get_char_id_by_name(self, name):
-        for i, ch in enumerate(self.char_list):
-            if ch.lower() == name.lower():
-                return i
-        raise ServerError("Character not found.")
+        char_id = self.char_trie.get(name)
+        if char_id is None:
+            raise ServerError("Character not found.")
+        return char_id
 
     def get_song_data(self, music):
         for item in self.music_list:
@@ -153,9 +513,19 @@ class TsuServer3:
         raise ServerError("Music not found.")
 
     def send_all_cmd_pred(self, cmd, *args, pred=lambda x: True):
+        data = encode_command(cmd, *args)
         for client in self.client_manager.clients:
             if pred(client):
-                client.send_command(cmd, *args)
+                client.send_raw_bytes(data)
+
+    def send_cmd_to(self, clients, cmd, *args):
+        """ Sends a command to a set of clients, encoding it only once.
+
+        :param clients: e.g. one of the ClientManager subscription sets
+        """
+        data = encode_command(cmd, *args)
+        for client in clients:
+            client.send_raw_bytes(data)
 
     def broadcast_global(self, client, msg, as_mod=False):
         char_name = client.get_char_name()
@@ -164,11 +534,94 @@ class TsuServer3:
         )
         if as_mod:
             ooc_name += "[M]"
-        self.send_all_cmd_pred("CT", ooc_name, msg)
-        if self.config["use_district"]:
-            self.district_client.send_raw_message(
-                "GLOBAL#{}#{}#{}#{}".format(int(as_mod), client.area.id, char_name, msg)
+        self.send_cmd_to(self.client_manager.global_listeners, "CT", ooc_name, msg)
+        if self.district_client:
+            self.district_client.send_command(
+                "GLOBAL", int(as_mod), client.area.id, char_name, msg
+            )
+        if self.federation_client:
+            self.federation_client.send_global(client, msg, as_mod)
+
+    def receive_global(self, server_name, area_id, char_name, msg, as_mod):
+        ooc_name = "{}[{}:{}][{}]".format(
+            self.config["globalname"], server_name, area_id, char_name
+        )
+        if as_mod:
+            ooc_name += "[M]"
+        self.send_cmd_to(self.client_manager.global_listeners, "CT", ooc_name, msg)
+
+    def broadcast_need(self, client, msg):
+        char_name = client.get_char_name()
+        area = client.area
+        need_msg = "=== Advert ===\r\n{} in {} [{}] needs {}\r\n===============".format(
+            char_name, area.name, area.id, msg
+        )
+        self.send_cmd_to(
+            self.client_manager.advert_listeners,
+            "CT",
+            self.config["hostname"],
+            need_msg,
+        )
+        if self.district_client:
+            self.district_client.send_command(
+                "NEED", char_name, area.name, area.id, msg
             )
+        if self.federation_client:
+            self.federation_client.send_need(client, msg)
+
+    def receive_need(self, server_name, char_name, area_name, area_id, msg):
+        need_msg = "=== Cross Advert ===\r\n{} at {} in {} [{}] needs {}\r\n====================".format(
+            char_name, server_name, area_name, area_id, msg
+        )
+        self.send_cmd_to(
+            self.client_manager.advert_listeners,
+            "CT",
+            self.config["hostname"],
+            need_msg,
+        )
+
+    def broadcast_modcall(self, client, msg):
+        text = "{} ({}) in {} ({}): {}".format(
+            client.get_char_name(),
+            client.get_ip(),
+            client.area.name,
+            client.area.id,
+            msg,
+        )
+        self.send_cmd_to(self.client_manager.moderators, "ZZ", text)
+        if self.federation_client:
+            self.federation_client.send_modcall(text)
+
+    def receive_modcall(self, server_name, text):
+        self.send_cmd_to(
+            self.client_manager.moderators, "ZZ", "[{}] {}".format(server_name, text)
+        )
+
+    def ban_ip(self, ip):
+        """ Bans an IP, kicks its clients and shares the ban with the federation.
+
+        :param ip: the IP to ban
+        :return: the number of kicked clients
+        """
+        self.ban_manager.add_ban(ip)
+        if self.federation_client:
+            self.federation_client.send_ban(ip)
+        return self.kick_ip(ip)
+
+    def receive_ban(self, ip):
+        if self.ban_manager.is_banned(ip):
+            return
+        self.ban_manager.add_ban(ip)
+        kicked = self.kick_ip(ip)
+        logger.log_server(
+            "Received federated ban of {}, kicked {} client(s).".format(ip, kicked)
+        )
+
+    def kick_ip(self, ip):
+        targets = self.client_manager.get_targets_by_ip(ip)
+        for c in targets:
+            c.disconnect()
+        return len(targets)
 
     def send_arup_players(self):
         area_players = [len(area.clients) for area in self.area_manager.areas]
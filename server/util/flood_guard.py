@@ -0,0 +1,177 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Detection of the same message repeated by one client, one IP or in one area.
+
+Every message is reduced to a 64-bit fingerprint, the hash of its
+normalized text, and remembered in small fixed-size windows for the
+sender, the sender's IP and the area. A message already in a window more
+often than allowed within the time window counts as a repeat. The windows
+have a fixed number of slots, so memory per client, IP and area and the
+time to check a message are constant no matter how busy the server is.
+
+An IP's window outlives its connections until everything in it expired,
+so reconnecting between messages doesn't start with a clean slate.
+"""
+
+import collections
+import time
+
+from server.util.content_filter import normalize
+
+CLIENT = "client"
+IP = "ip"
+AREA = "area"
+SCOPES = (CLIENT, IP, AREA)
+
+
+def fingerprint(text):
+    """ A 64-bit fingerprint, equal for texts differing in case, spacing or look-alike characters. """
+    return hash(" ".join(normalize(text).split()))
+
+
+class FingerprintWindow:
+    """ A ring buffer of the last few fingerprints and when they were seen. """
+
+    __slots__ = ("hashes", "times", "pos")
+
+    def __init__(self, size):
+        self.hashes = [None] * size
+        self.times = [0.0] * size
+        self.pos = 0
+
+    def add(self, value, now, since):
+        """ Records a fingerprint.
+
+        :param since: only earlier copies seen at or after this time count
+        :return: the number of earlier copies still in the window
+        """
+        count = 0
+        if value in self.hashes:
+            for other, seen in zip(self.hashes, self.times):
+                if other == value and seen >= since:
+                    count += 1
+        self.hashes[self.pos] = value
+        self.times[self.pos] = now
+        self.pos = (self.pos + 1) % len(self.hashes)
+        return count
+
+    @property
+    def last_seen(self):
+        return self.times[self.pos - 1]
+
+
+class FloodGuard:
+    """ Finds repeated messages before they're broadcast.
+
+    :param window: seconds a message is remembered for
+    :param size: fingerprints remembered per client, IP and area
+    :param limits: dict of scope -> copies allowed within the window
+    :param min_length: shorter messages, like "..." or an empty IC line, are never checked
+    :param drop: whether repeats are dropped, or only flagged to moderators
+    """
+
+    def __init__(self, window=10, size=8, limits=None, min_length=8, drop=True):
+        self.window = window
+        self.size = size
+        self.limits = {CLIENT: 2, IP: 3, AREA: 3}
+        if limits:
+            self.limits.update(limits)
+        self.min_length = min_length
+        self.drop = drop
+        self._clients = {}
+        # ordered from the least recently used, for pruning expired windows
+        self._ips = collections.OrderedDict()
+        self._areas = {}
+        self.checked = collections.Counter()
+        self.suppressed = collections.Counter()
+        self.saved = collections.Counter()
+
+    def leave(self, client):
+        self._clients.pop(client.id, None)
+
+    def check(self, command, client, text):
+        """ Records a message and finds out if it repeats a recent one.
+
+        :param command: the network command, e.g. MS, only used for the statistics
+        :return: None if the message may be sent, otherwise (scope, first),
+            first being True for the first copy over the scope's limit
+        """
+        if len(text) < self.min_length:
+            return None
+        value = fingerprint(text)
+        now = time.monotonic()
+        since = now - self.window
+        self.checked[command] += 1
+
+        window = self._clients.get(client.id)
+        if window is None:
+            window = self._clients[client.id] = FingerprintWindow(self.size)
+        ip = self._ips.get(client.get_ip())
+        if ip is None:
+            ip = self._ips[client.get_ip()] = FingerprintWindow(self.size)
+        else:
+            self._ips.move_to_end(client.get_ip())
+        area = self._areas.get(client.area.id)
+        if area is None:
+            area = self._areas[client.area.id] = FingerprintWindow(self.size)
+
+        # every window records the message, so a repeat keeps counting
+        # in the scopes it didn't trip yet
+        counts = (
+            window.add(value, now, since),
+            ip.add(value, now, since),
+            area.add(value, now, since),
+        )
+        # every IP is pruned once, so this is constant time on average,
+        # the sender's own IP was just used and is last
+        ips = self._ips
+        while len(ips) > 1:
+            oldest = next(iter(ips.values()))
+            if oldest.last_seen >= since:
+                break
+            ips.popitem(last=False)
+        for scope, count in zip(SCOPES, counts):
+            limit = self.limits[scope]
+            if count >= limit:
+                self.suppressed[command, scope] += 1
+                if self.drop:
+                    self.saved[command] += len(client.area.clients)
+                return scope, count == limit
+        return None
+
+    def reset(self):
+        self.checked.clear()
+        self.suppressed.clear()
+        self.saved.clear()
+
+    def render(self):
+        lines = ["[FLOOD]"]
+        for command, checked in sorted(self.checked.items()):
+            lines.append(
+                "{}: checked={} suppressed {}, {} packets saved".format(
+                    command,
+                    checked,
+                    " ".join(
+                        "{}={}".format(scope, self.suppressed[command, scope])
+                        for scope in SCOPES
+                    ),
+                    self.saved[command],
+                )
+            )
+        return "\r\n".join(lines)
@@ -16,11 +16,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import logging.handlers
+import queue
 
 import time
 
+_listener = None
+
 
 def setup_logger(debug):
+    """ Sets up the debug and server logs.
+
+    Records are put on a queue and written to the log files by a
+    background thread, so a slow disk doesn't stall the event loop.
+    """
+    global _listener
     logging.Formatter.converter = time.gmtime
     debug_formatter = logging.Formatter("[%(asctime)s UTC]%(message)s")
     srv_formatter = logging.Formatter("[%(asctime)s UTC]%(message)s")
@@ -31,7 +41,7 @@ def setup_logger(debug):
     debug_handler = logging.FileHandler("logs/debug.log", encoding="utf-8")
     debug_handler.setLevel(logging.DEBUG)
     debug_handler.setFormatter(debug_formatter)
-    debug_log.addHandler(debug_handler)
+    debug_handler.addFilter(lambda record: record.name == "debug")
 
     if not debug:
         debug_log.disabled = True
@@ -42,7 +52,24 @@ def setup_logger(debug):
     server_handler = logging.FileHandler("logs/server.log", encoding="utf-8")
     server_handler.setLevel(logging.INFO)
     server_handler.setFormatter(srv_formatter)
-    server_log.addHandler(server_handler)
+    server_handler.addFilter(lambda record: record.name == "server")
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    debug_log.addHandler(queue_handler)
+    server_log.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(
+        records, debug_handler, server_handler, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def stop_logger():
+    """ Writes the queued records and stops the log writer thread. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
 
 
 def log_debug(msg, client=None):
@@ -0,0 +1,219 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory accounting for finding out what grows over long uptimes.
+
+deep_sizeof estimates how much memory an object keeps alive by walking
+its containers and attributes, MemoryTracer wraps tracemalloc so tracing
+can be turned on and off at runtime and snapshots compared.
+"""
+
+import asyncio
+import collections
+import gc
+import linecache
+import sys
+import tracemalloc
+import types
+
+from server.areas.area import Area
+from server.areas.evidence_manager import EvidenceManager
+from server.clients.client import Client
+from server.util.exceptions import ServerError
+from server.util.perf import format_bytes
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# never followed, they're shared or aren't data, transports are
+# accounted for by their write buffer size
+OPAQUE_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.MethodType,
+    asyncio.AbstractEventLoop,
+    asyncio.BaseTransport,
+)
+
+
+def deep_sizeof(obj, stop=(), seen=None):
+    """ Approximates the memory kept alive by obj.
+
+    :param stop: types whose instances aren't followed, e.g. the server an object refers to
+    :param seen: ids of objects already counted, shared between calls to not count twice
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    root = obj
+    todo = [obj]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, OPAQUE_TYPES):
+            continue
+        if obj is not root and isinstance(obj, stop):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            todo.extend(obj)
+        elif not isinstance(obj, (str, bytes, int, float)):
+            attrs = getattr(obj, "__dict__", None)
+            if attrs is not None:
+                todo.append(attrs)
+            for name in getattr(type(obj), "__slots__", ()):
+                if hasattr(obj, name):
+                    todo.append(getattr(obj, name))
+    return size
+
+
+def peak_rss():
+    """ The peak resident set size in bytes, None where unknown. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryTracer:
+    """ Starts and stops tracemalloc and diffs snapshots taken in between.
+
+    Each snapshot is compared to the previous one, so taking one, waiting
+    and taking another shows what was allocated and not freed in between.
+    """
+
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.previous = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if self.tracing:
+            raise ServerError("Memory tracing is already running.")
+        tracemalloc.start(self.frames)
+        self.previous = None
+
+    def stop(self):
+        if not self.tracing:
+            raise ServerError("Memory tracing isn't running.")
+        tracemalloc.stop()
+        self.previous = None
+
+    def take_snapshot(self):
+        if not self.tracing:
+            raise ServerError("Memory tracing isn't running.")
+        # leave out tracemalloc itself and the source lines cached for writing diffs
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, linecache.__file__),
+            )
+        )
+        previous, self.previous = self.previous, snapshot
+        return previous, snapshot
+
+    @staticmethod
+    def write_diff(previous, snapshot, path_base, top=10):
+        """ Writes the snapshot and its difference to the previous one.
+
+        Slow with many traces, so this is meant to run off the event loop.
+
+        :return: the top lines of the difference, or of the snapshot if it's the first
+        """
+        snapshot.dump(path_base + ".snapshot")
+        if previous is None:
+            stats = snapshot.statistics("lineno")
+            title = "Top allocations"
+        else:
+            stats = snapshot.compare_to(previous, "lineno")
+            title = "Top growth since the previous snapshot"
+        with open(path_base + ".txt", "w", encoding="utf-8") as f:
+            f.write(title + "\n")
+            for stat in stats:
+                f.write("{}\n".format(stat))
+                for line in stat.traceback.format():
+                    f.write("    {}\n".format(line))
+        lines = ["=== {} ===".format(title)]
+        lines += [str(stat) for stat in stats[:top]]
+        return "\r\n".join(lines)
+
+    def render_status(self):
+        if not self.tracing:
+            return "tracemalloc: off"
+        current, peak = tracemalloc.get_traced_memory()
+        return "tracemalloc: {} traced, {} peak, {} overhead".format(
+            format_bytes(current),
+            format_bytes(peak),
+            format_bytes(tracemalloc.get_tracemalloc_memory()),
+        )
+
+
+def render_report(server, tracer):
+    """ Counts and sizes of the objects that could grow over time. """
+    # counting live instances finds ones that are no longer in any manager
+    live = collections.Counter()
+    tracked = gc.get_objects()
+    for obj in tracked:
+        if isinstance(obj, (Client, Area, EvidenceManager)):
+            live[type(obj).__name__] += 1
+
+    clients = server.client_manager.clients
+    areas = server.area_manager.areas
+    stop = (type(server), Area, Client)
+    seen = set()
+
+    client_size = sum(deep_sizeof(c, stop, seen) for c in clients)
+    evidence_size = sum(deep_sizeof(a.evidence_manager, stop, seen) for a in areas)
+    history_size = sum(a.history.size for a in areas)
+    area_size = sum(deep_sizeof(a, stop, seen) for a in areas)
+    buffered = sum(c.network.get_write_buffer_size() for c in clients)
+
+    lines = [
+        "=== Memory ===",
+        "Client: {} live, {} connected, ~{}".format(
+            live["Client"], len(clients), format_bytes(client_size)
+        ),
+        "Area: {} live, {} loaded, ~{} ({} of chat history)".format(
+            live["Area"],
+            len(areas),
+            format_bytes(area_size),
+            format_bytes(history_size),
+        ),
+        "EvidenceManager: {} live, {} pieces, ~{}".format(
+            live["EvidenceManager"],
+            sum(len(a.evidence_manager.get_evidence_list()) for a in areas),
+            format_bytes(evidence_size),
+        ),
+        "Outbound buffers: {} queued".format(format_bytes(buffered)),
+        "GC: {} objects tracked".format(len(tracked)),
+        tracer.render_status(),
+    ]
+    rss = peak_rss()
+    if rss is not None:
+        lines.insert(1, "Peak RSS: {}".format(format_bytes(rss)))
+    return "\r\n".join(lines)
@@ -0,0 +1,66 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class NameTrie:
+    """ A case-insensitive prefix tree mapping names to values.
+
+    Names are compared case-folded. If two names fold to the same key,
+    the one inserted first keeps it.
+    """
+
+    def __init__(self, names=None):
+        """
+        :param names: optional iterable of names, each mapped to its index
+        """
+        self._root = {}
+        if names is not None:
+            for i, name in enumerate(names):
+                self.insert(name, i)
+
+    def insert(self, name, value):
+        node = self._root
+        for char in name.casefold():
+            node = node.setdefault(char, {})
+        # None can't be a character, so it's safe to mark the end of a name with
+        node.setdefault(None, value)
+
+    def get(self, name, default=None):
+        """ The value of the name, compared case-insensitively. """
+        node = self._root
+        for char in name.casefold():
+            node = node.get(char)
+            if node is None:
+                return default
+        return node.get(None, default)
+
+    def prefixes(self, text):
+        """ The names text starts with, as whole words, shortest first.
+
+        :return: list of (value, rest of the text after the name)
+        """
+        matches = []
+        node = self._root
+        for i, char in enumerate(text):
+            # folding can turn one character into several
+            for folded in char.casefold():
+                node = node.get(folded)
+                if node is None:
+                    return matches
+            if None in node and (i + 1 == len(text) or text[i + 1].isspace()):
+                matches.append((node[None], text[i + 1 :].lstrip()))
+        return matches
@@ -0,0 +1,164 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight latency statistics for network and OOC commands.
+
+Latencies are kept in log-bucketed histograms (in the spirit of HdrHistogram),
+every power of two is split into a fixed number of linear sub-buckets, which
+keeps the relative error of any reported percentile under 1 / SUB_BUCKETS.
+"""
+
+import time
+
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def bucket_index(value):
+    """ Maps a non-negative integer onto its histogram bucket. """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_upper_bound(index):
+    """ Returns the highest value that still falls into a bucket. """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = (index & (SUB_BUCKETS - 1)) + SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """ A log-bucketed histogram of latencies in microseconds. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.bytes = 0
+        self._buckets = {}
+
+    def record(self, value, nbytes=0):
+        idx = bucket_index(value)
+        self._buckets[idx] = self._buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.bytes += nbytes
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """ Returns the given percentile (0-100) of recorded values. """
+        if self.count == 0:
+            return 0
+        target = max(1, round(self.count * pct / 100.0))
+        seen = 0
+        for idx in sorted(self._buckets):
+            seen += self._buckets[idx]
+            if seen >= target:
+                return min(bucket_upper_bound(idx), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+
+def format_us(value):
+    if value >= 1000000:
+        return "{:.2f}s".format(value / 1000000)
+    if value >= 1000:
+        return "{:.2f}ms".format(value / 1000)
+    return "{}us".format(int(value))
+
+
+def format_bytes(value):
+    if value >= 1 << 20:
+        return "{:.1f}MB".format(value / (1 << 20))
+    if value >= 1 << 10:
+        return "{:.1f}KB".format(value / (1 << 10))
+    return "{}B".format(value)
+
+
+class PerfStats:
+    """ Collects per-command latency histograms and outbound byte counts.
+
+    Network commands are keyed by their AO command name (e.g. MS),
+    OOC commands by their slash command name (e.g. roll).
+    """
+
+    NET = "net"
+    OOC = "ooc"
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+        self.histograms = {self.NET: {}, self.OOC: {}}
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.histograms = {self.NET: {}, self.OOC: {}}
+
+    def measure(self, kind, name, func, *args):
+        """ Runs func(*args) and records its latency and outgoing bytes.
+
+        Exceptions raised by func are propagated, but still recorded.
+        """
+        hists = self.histograms[kind]
+        start_bytes = self.bytes_sent
+        start = time.perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            elapsed = (time.perf_counter_ns() - start) // 1000
+            try:
+                hist = hists[name]
+            except KeyError:
+                hist = hists[name] = LatencyHistogram()
+            hist.record(elapsed, self.bytes_sent - start_bytes)
+
+    def render(self, kind=None):
+        """ Renders the collected statistics as a human readable table. """
+        kinds = (kind,) if kind else (self.NET, self.OOC)
+        lines = [
+            "=== Performance ({:.0f}s, {} sent) ===".format(
+                time.monotonic() - self.started, format_bytes(self.bytes_sent)
+            )
+        ]
+        for k in kinds:
+            hists = self.histograms[k]
+            if not hists:
+                continue
+            lines.append("[{}]".format(k.upper()))
+            ordered = sorted(hists.items(), key=lambda x: x[1].total, reverse=True)
+            for name, hist in ordered:
+                lines.append(
+                    "{}: n={} p50={} p99={} max={} out={}".format(
+                        name,
+                        hist.count,
+                        format_us(hist.percentile(50)),
+                        format_us(hist.percentile(99)),
+                        format_us(hist.max),
+                        format_bytes(hist.bytes),
+                    )
+                )
+        return "\r\n".join(lines)
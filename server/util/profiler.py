@@ -0,0 +1,198 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2020 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A sampling profiler for the event loop thread.
+
+While running, a background thread looks at the event loop thread's stack
+every interval through sys._current_frames() and counts the stacks it
+sees. Nothing is hooked into the profiled code, so the server runs at
+full speed and there's no cost at all while no profile is running.
+
+Results are written as a pstats file, loadable with pstats.Stats or tools
+like snakeviz, where call counts are sample counts, and as collapsed
+stacks, one "frame;frame;frame count" line per stack, for flamegraph.pl
+or speedscope.
+"""
+
+import collections
+import marshal
+import os
+import sys
+import threading
+import time
+
+from server.util.exceptions import ServerError
+
+
+def frame_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def format_key(key):
+    filename, lineno, name = key
+    path = os.path.relpath(filename)
+    if path.startswith(".."):
+        # the standard library and other installed packages
+        path = os.path.basename(filename)
+    return "{} ({}:{})".format(name, path, lineno)
+
+
+class Profile:
+    """ The stacks collected by one profiling run. """
+
+    def __init__(self, stacks, samples, duration):
+        self.stacks = stacks
+        self.samples = samples
+        self.duration = duration
+
+    def to_pstats(self):
+        """ Builds the dict pstats.Stats loads, timings are estimated from the samples. """
+        per_sample = self.duration / self.samples if self.samples else 0.0
+        stats = {}
+        for stack, count in self.stacks.items():
+            leaf = stack[-1]
+            seen = set()
+            for i, key in enumerate(stack):
+                if key in seen:
+                    continue
+                seen.add(key)
+                cc, nc, tt, ct, callers = stats.get(key, (0, 0, 0.0, 0.0, {}))
+                if key == leaf:
+                    tt += count * per_sample
+                stats[key] = (
+                    cc + count,
+                    nc + count,
+                    tt,
+                    ct + count * per_sample,
+                    callers,
+                )
+                if i > 0:
+                    caller = stack[i - 1]
+                    edge = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (
+                        edge[0] + count,
+                        edge[1] + count,
+                        edge[2],
+                        edge[3] + count * per_sample,
+                    )
+        return stats
+
+    def collapsed(self):
+        lines = []
+        for stack, count in self.stacks.items():
+            lines.append("{} {}".format(";".join(map(format_key, stack)), count))
+        return "\n".join(lines) + "\n"
+
+    def top(self, count=10):
+        """ The functions the most samples ended in.
+
+        :return: list of (function, self %, total %)
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for key in set(stack):
+                total[key] += n
+        return [
+            (
+                format_key(key),
+                100.0 * n / self.samples,
+                100.0 * total[key] / self.samples,
+            )
+            for key, n in own.most_common(count)
+        ]
+
+    def render(self, count=10):
+        lines = [
+            "=== Profile, {} samples in {:.1f}s ===".format(
+                self.samples, self.duration
+            ),
+            "  self  total  function",
+        ]
+        for name, own, total in self.top(count):
+            lines.append("{:5.1f}% {:5.1f}%  {}".format(own, total, name))
+        return "\r\n".join(lines)
+
+    def write(self, path_base):
+        """ Writes path_base.pstats and path_base.folded. """
+        with open(path_base + ".pstats", "wb") as f:
+            marshal.dump(self.to_pstats(), f)
+        with open(path_base + ".folded", "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+
+
+class SamplingProfiler:
+    """ Profiles one thread for a bounded window, at most one run at a time.
+
+    :param interval: seconds between samples
+    """
+
+    MAX_DURATION = 300
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, on_done, thread_id=None):
+        """ Starts profiling in the background.
+
+        :param duration: seconds to profile for
+        :param on_done: called with the Profile from the sampling thread
+        :param thread_id: the thread to profile, the calling one by default
+        """
+        if self.running:
+            raise ServerError("A profile is already running.")
+        if not 0 < duration <= self.MAX_DURATION:
+            raise ServerError(
+                "Profile duration must be between 1 and {} seconds.".format(
+                    self.MAX_DURATION
+                )
+            )
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(thread_id, duration, on_done),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, thread_id, duration, on_done):
+        stacks = collections.Counter()
+        samples = 0
+        started = time.monotonic()
+        deadline = started + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame_key(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            stacks[tuple(stack)] += 1
+            samples += 1
+            time.sleep(self.interval)
+        on_done(Profile(stacks, samples, time.monotonic() - started))
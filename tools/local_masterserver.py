@@ -0,0 +1,68 @@
+# A stand-in master server for testing the master server link locally.
+
+# Usage:
+#   python tools/local_masterserver.py [port] [--noserv]
+#
+# Point masterserver_ip / masterserver_port in config.yaml at it. Every
+# message from the server is printed, a CHECK heartbeat is sent every few
+# seconds and with --noserv, the first heartbeat is replaced by NOSERV to
+# make the server resend its info.
+
+import asyncio
+import sys
+import time
+
+CHECK_INTERVAL = 5
+
+port = 27016
+noserv = "--noserv" in sys.argv
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+if args:
+    port = int(args[0])
+
+
+def log(peer, msg):
+    print("{} {}:{} {}".format(time.strftime("%H:%M:%S"), peer[0], peer[1], msg))
+
+
+async def heartbeat(writer):
+    first = True
+    while not writer.is_closing():
+        await asyncio.sleep(CHECK_INTERVAL)
+        if first and noserv:
+            writer.write(b"NOSERV#%")
+        else:
+            writer.write(b"CHECK#%")
+        first = False
+
+
+async def handle_server(reader, writer):
+    peer = writer.get_extra_info("peername")
+    log(peer, "connected")
+    task = asyncio.ensure_future(heartbeat(writer))
+    try:
+        while True:
+            data = await reader.readuntil(b"#%")
+            msg = data[:-2].decode("utf-8", "replace")
+            log(peer, msg)
+            if msg == "PING":
+                writer.write(b"PONG#%")
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        task.cancel()
+        writer.close()
+        log(peer, "disconnected")
+
+
+async def main():
+    server = await asyncio.start_server(handle_server, "127.0.0.1", port)
+    print("Listening on 127.0.0.1:{}".format(port))
+    async with server:
+        await server.serve_forever()
+
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass